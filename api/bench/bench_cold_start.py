@@ -0,0 +1,118 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+#
+# Cold start and warm cost of every Lambda's AWS clients. Each Lambda is
+# imported in a fresh interpreter, as in a new container; then every client
+# getter is called once (cold, which is also what each call cost before
+# clients were cached per container) and again WARM_CALLS times. Clients
+# are only constructed, so no AWS access is needed; the OpenSearch client
+# needs opensearch-py and requests-aws4auth installed.
+#
+# Usage: python api/bench/bench_cold_start.py [runs]
+#
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+LAMBDAS = {
+    'history': ('api/history', ['get_dynamodb']),
+    'recommend': ('api/recommend', ['get_dynamodb', 'get_opensearch']),
+    'summary': ('api/summary', ['get_table']),
+    'trending': ('api/trending', ['get_table', 'get_opensearch']),
+    'processor': ('processor/processor/src', ['get_dynamodb', 'get_client']),
+    'indexer': ('processor/indexer/src',
+                ['get_table', 'get_s3', 'get_opensearch']),
+}
+
+# Placeholders for the settings every index.py reads at import time
+ENVIRONMENT = {
+    'REGION': 'us-east-1',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'bench',
+    'AWS_SECRET_ACCESS_KEY': 'bench',
+    'METADATA_TABLE': 'metadata',
+    'INF_METADATA_TABLE': 'inference-metadata',
+    'HISTORY_TABLE': 'history',
+    'PAYLOAD_BUCKET': 'payload',
+    'CLASSIFICATION_BUCKET': 'classification',
+    'SUMMARY_BUCKET': 'summary',
+    'CLASSIFICATION_ENDPOINT': 'classification',
+    'SUMMARY_ENDPOINT': 'summary',
+    'OPENSEARCH_ENDPOINT': 'localhost',
+    'OPENSEARCH_INDEX': 'news',
+}
+
+WARM_CALLS = 100
+
+GETTER_ARGS = {
+    'get_table': ('metadata', ),
+    'get_client': ('s3', ),
+}
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+def child(path, getters):
+    # Runs in the fresh interpreter
+    sys.path.insert(0, path)
+    start = time.perf_counter()
+    import index
+    result = {'import': (time.perf_counter() - start) * 1000}
+
+    for name in getters:
+        getter = getattr(index, name)
+        args = GETTER_ARGS.get(name, ())
+        try:
+            cold = timed(getter, *args)
+        except ImportError as e:
+            print(f'@child: {name} skipped, {e}', file=sys.stderr)
+            continue
+        warm = sum(timed(getter, *args) for _ in range(WARM_CALLS))
+        result[name] = (cold, warm / WARM_CALLS)
+
+    print(json.dumps(result))
+
+
+def run(path, getters):
+    env = dict(os.environ)
+    for key, value in ENVIRONMENT.items():
+        env.setdefault(key, value)
+    out = subprocess.run(
+        [sys.executable, __file__, '--child', path, ','.join(getters)],
+        env=env, check=True, capture_output=True, text=True)
+    return json.loads(out.stdout.splitlines()[-1])
+
+
+def main(argv):
+    if argv and argv[0] == '--child':
+        child(argv[1], argv[2].split(','))
+        return
+
+    runs = int(argv[0]) if argv else 5
+    print(f'median of {runs} fresh interpreters, ms')
+    print(f'{"lambda":<10} {"client":<15} {"import":>8} {"cold":>8} '
+          f'{"warm":>8}')
+    for name, (path, getters) in LAMBDAS.items():
+        results = [run(os.path.join(ROOT, path), getters)
+                   for _ in range(runs)]
+        imported = statistics.median(r['import'] for r in results)
+        print(f'{name:<10} {"":<15} {imported:8.1f}')
+        for getter in getters:
+            if getter not in results[0]:
+                print(f'{"":<10} {getter:<15} {"":>8} {"skipped":>8}')
+                continue
+            cold = statistics.median(r[getter][0] for r in results)
+            warm = statistics.median(r[getter][1] for r in results)
+            print(f'{"":<10} {getter:<15} {"":>8} {cold:8.2f} {warm:8.4f}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,104 +1,372 @@
+import atexit
 import json
 import os
+import random
 import decimal
+import time
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
-from botocore.exceptions import ClientError
 
 REGION = os.environ['REGION']
 METADATA_TABLE = os.environ['METADATA_TABLE']
 HISTORY_TABLE = os.environ['HISTORY_TABLE']
 
+# A user's clicks are counted on a single item, keyed by the userid and
+# this suffix, with one attribute per tag named by the prefix and tag
+USER_CLICKS_SUFFIX = '#clicks'
+TAG_PREFIX = 'tag:'
+
+# Items the global click counter is spread over; must be the same in
+# api/history and api/recommend
+COUNTER_SHARDS = int(os.environ.get('COUNTER_SHARDS', '10'))
+
+# How click events are written: 'sync' applies each one before replying,
+# 'queue' sends them to HISTORY_QUEUE_URL to be applied in micro-batches
+# when the queue triggers this function, and 'local' buffers them in
+# memory instead of a queue, for running the function outside AWS
+INGEST_MODE = os.environ.get('HISTORY_INGEST_MODE', 'sync')
+QUEUE_URL = os.environ.get('HISTORY_QUEUE_URL')
+# Events buffered by the local queue before they are applied, and the
+# longest the oldest of them waits
+LOCAL_BATCH_SIZE = int(os.environ.get('HISTORY_LOCAL_BATCH_SIZE', '100'))
+LOCAL_BATCH_WINDOW = float(os.environ.get('HISTORY_LOCAL_BATCH_WINDOW', '10'))
+
+EVENTS = {'like', 'dislike', 'read', 'readmore'}
+
+HEADERS = {
+    'Content-Type': 'application/json',
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': '*',
+}
+
+
+# Created on first use and reused by warm invocations of the container
+_dynamodb = None
+_queue = None
+
+
+def get_dynamodb():
+    global _dynamodb
+    if _dynamodb is None:
+        _dynamodb = boto3.resource('dynamodb')
+    return _dynamodb
+
+
+def get_table(name):
+    return get_dynamodb().Table(name)
+
+
+class ShardedCounter:
+    # A counter spread over several items, '<name>#<shard>', so that the
+    # increments of a hot counter land on different partitions. Writers
+    # pick a shard at random; api/recommend sums every shard on read.
+    def __init__(self, name, shards=COUNTER_SHARDS):
+        self.name = name
+        self.shards = shards
+
+    def shard_key(self):
+        return '%s#%d' % (self.name, random.randrange(self.shards))
+
+
+TOTAL_CLICKS = ShardedCounter('totalsum')
+
+
+def get_queue():
+    global _queue
+    if _queue is None:
+        if INGEST_MODE == 'local':
+            _queue = LocalQueue(LOCAL_BATCH_SIZE, LOCAL_BATCH_WINDOW)
+        else:
+            _queue = SQSQueue(QUEUE_URL)
+    return _queue
+
+
+class SQSQueue:
+    def __init__(self, url):
+        self.url = url
+        self.client = boto3.client('sqs')
+
+    def send(self, click):
+        self.client.send_message(QueueUrl=self.url,
+                                 MessageBody=json.dumps(click))
+
+
+class LocalQueue:
+    # Same micro-batches as the SQS trigger, without the queue: events are
+    # held in memory and applied once batch_size of them are waiting, when
+    # an event arrives after the oldest has waited window seconds, or on
+    # flush(). Whatever is left is flushed when the process exits.
+    def __init__(self, batch_size, window):
+        self.batch_size = batch_size
+        self.window = window
+        self.clicks = []
+        self.started = None
+        atexit.register(self.close)
+
+    def send(self, click):
+        if not self.clicks:
+            self.started = time.monotonic()
+        self.clicks.append(click)
+        if (len(self.clicks) >= self.batch_size
+                or time.monotonic() - self.started >= self.window):
+            self.flush()
+
+    def flush(self, workers=8):
+        clicks, self.clicks = self.clicks, []
+        if clicks:
+            # There is no queue to hand failed updates back to; ingest()
+            # has printed them
+            ingest(clicks, workers)
+
+    def close(self):
+        # No new threads can be started while the interpreter shuts down
+        self.flush(workers=1)
+
 
 def lambda_handler(event, context):
     print('Received event: ' + json.dumps(event))
 
-    userid = event['headers']['userid']
-    data = json.loads(event['body'])
+    # Micro-batch of click events delivered by the queue
+    if 'Records' in event:
+        return ingest_records(event['Records'])
 
-    handle_event(userid, data['key'], data['event'])
+    try:
+        data = json.loads(event['body'])
+        click = {
+            'userid': (event.get('headers') or {}).get('userid'),
+            'key': data.get('key'),
+            'event': data.get('event')
+        }
+    except (TypeError, ValueError, AttributeError):
+        click = None
+
+    if not is_valid(click):
+        return response(400, {'ok': False, 'error': 'Invalid click event'})
 
+    if INGEST_MODE == 'sync':
+        if ingest([click]):
+            return response(500, {'ok': False})
+    else:
+        get_queue().send(click)
+
+    return response(200, {'ok': True})
+
+
+def response(status, body):
     return {
-        'statusCode': 200,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Headers': 'Content-Type',
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': '*',
-        },
-        'body': json.dumps({'ok': True})
+        'statusCode': status,
+        'headers': HEADERS,
+        'body': json.dumps(body)
     }
 
 
-def handle_event(userid, key, event):
-    if event == 'like':
-        insert_item({'key': userid + key + 'like', 'read': True}, HISTORY_TABLE)
-        handle_counter(userid, key, True)
-    elif event == 'dislike':
-        insert_item({
-            'key': userid + key + 'like',
-            'read': False
-        }, HISTORY_TABLE)
-        handle_counter(userid, key, False)
-    elif event == 'read' or event == 'readmore':
-        handle_counter(userid, key, True)
+def is_valid(click):
+    # An empty or non-string key would fail the BatchGetItem of the whole
+    # batch it is read with
+    return (isinstance(click, dict)
+            and isinstance(click.get('userid'), str) and click['userid']
+            and isinstance(click.get('key'), str) and click['key']
+            and click.get('event') in EVENTS)
 
 
-def handle_counter(userid, key, increase):
-    tags = get_item({'UrlHash': key}, METADATA_TABLE)['Item']['tags']
-    for t in tags:
-        update_counter(userid + t, HISTORY_TABLE, increase)
+def ingest_records(records):
+    # Records are either click events or, as {"updates": [...]}, updates
+    # of an earlier batch that could not be applied. Invalid records are
+    # dropped, as no retry would make them valid
+    clicks = []
+    updates = []
+    for r in records:
+        try:
+            body = json.loads(r['body'])
+        except ValueError:
+            body = None
 
-    update_counter('totalsum', HISTORY_TABLE, increase)
+        if isinstance(body, dict) and 'updates' in body:
+            updates += [load_update(u) for u in body['updates']]
+        elif is_valid(body):
+            clicks.append(body)
+        else:
+            print('@ingest_records: dropping invalid record', r['body'])
 
-    res = get_item({'key': 'tags'}, HISTORY_TABLE)
-    old_tags = []
-    if 'Item' in res:
-        old_tags = res['Item']['tags']
+    try:
+        failed = ingest(clicks, updates=updates)
+    except Exception as e:
+        # Raised before any counter was updated, so the whole batch can be
+        # delivered again
+        print('@ingest_records: batch failed,', e)
+        return {
+            'batchItemFailures': [{
+                'itemIdentifier': r['messageId']
+            } for r in records]
+        }
 
-    old_tags.extend(tags)
-    old_tags = list(set(old_tags))
+    # A retried batch would add the updates that did succeed a second
+    # time; only the failed ones are queued again, as a message of their own
+    if failed:
+        get_queue().send({'updates': [dump_update(u) for u in failed]})
 
-    insert_item({'key': 'tags', 'tags': old_tags}, HISTORY_TABLE)
+    return {'batchItemFailures': []}
 
 
-def update_counter(key, table, increase):
-    db = boto3.resource('dynamodb')
-    table = db.Table(table)
+def dump_update(update):
+    (key, exp, values, names) = update
+    values = {
+        n: sorted(v) if isinstance(v, set) else int(v)
+        for n, v in values.items()
+    }
+    return [key, exp, values, names]
 
-    exp = 'set ct = if_not_exists(ct, :val0) + :val'
-    if not increase:
-        exp = 'set ct = if_not_exists(ct, :val0) - :val'
 
-    response = table.update_item(Key={'key': key},
-                                 UpdateExpression=exp,
-                                 ExpressionAttributeValues={
-                                     ':val': decimal.Decimal(1),
-                                     ':val0': decimal.Decimal(0)
-                                 },
-                                 ReturnValues='UPDATED_NEW')
+def load_update(update):
+    (key, exp, values, names) = update
+    values = {
+        n: set(v) if isinstance(v, list) else decimal.Decimal(v)
+        for n, v in values.items()
+    }
+    return (key, exp, values, names)
 
-    print(response)
 
+def ingest(clicks, workers=8, updates=()):
+    # Returns the updates that could not be applied; updates are applied
+    # along with those of the clicks
+    likes, users, total, vocabulary = aggregate(clicks)
 
-def insert_item(item, table):
-    db = boto3.resource('dynamodb')
-    table = db.Table(table)
+    # Later events of the batch overwrite earlier ones of the same article
+    with get_table(HISTORY_TABLE).batch_writer() as batch:
+        for key, read in likes.items():
+            batch.put_item(Item={'key': key, 'read': read})
 
-    response = table.put_item(Item=item)
+    # Each write is a single ADD, which DynamoDB applies atomically, so
+    # concurrent batches neither lose counts nor tags; the writes do not
+    # depend on each other and are sent together
+    updates = list(updates)
+    for userid, counts in users.items():
+        names = {}
+        values = {}
+        adds = []
+        for i, (name, delta) in enumerate(counts.items()):
+            names['#c%d' % i] = name
+            values[':v%d' % i] = decimal.Decimal(delta)
+            adds.append('#c%d :v%d' % (i, i))
 
-    print('@insert_item: response', response)
-    return response
+        exp = 'ADD ' + ', '.join(adds)
+        updates.append((userid + USER_CLICKS_SUFFIX, exp, values, names))
 
+    if total:
+        updates.append((TOTAL_CLICKS.shard_key(), 'ADD ct :val', {
+            ':val': decimal.Decimal(total)
+        }, None))
 
-def get_item(key, table):
-    db = boto3.resource('dynamodb')
-    table = db.Table(table)
+    if vocabulary:
+        updates.append(('tags', 'ADD tagset :tags', {
+            ':tags': vocabulary
+        }, None))
 
-    try:
-        response = table.get_item(Key=key)
-    except ClientError as e:
-        print('Error', e.response['Error']['Message'])
+    if updates and workers > 1:
+        with ThreadPoolExecutor(
+                max_workers=min(len(updates), workers)) as executor:
+            applied = list(executor.map(try_update, updates))
     else:
-        print('@get_item: response', response)
-        return response
+        applied = [try_update(u) for u in updates]
+
+    failed = [u for u, ok in zip(updates, applied) if not ok]
+    print('@ingest:', len(clicks), 'events,', len(likes) + len(updates),
+          'writes,', len(failed), 'failed')
+    return failed
+
+
+def try_update(update):
+    try:
+        update_item(HISTORY_TABLE, *update)
+    except Exception as e:
+        print('@try_update: could not update', update[0], e)
+        return False
+    return True
+
+
+def aggregate(clicks):
+    tags = get_tags(set(c['key'] for c in clicks))
+
+    # Summed deltas of the batch, so each counter is written once however
+    # many events touched it
+    likes = {}
+    users = {}
+    total = 0
+    vocabulary = set()
+    for c in clicks:
+        event = c['event']
+        if event == 'like' or event == 'dislike':
+            likes[c['userid'] + c['key'] + 'like'] = event == 'like'
+
+        if event == 'like' or event == 'read' or event == 'readmore':
+            delta = 1
+        elif event == 'dislike':
+            delta = -1
+        else:
+            continue
+
+        if c['key'] not in tags:
+            print('Unknown article', c['key'])
+            continue
+
+        counts = users.setdefault(c['userid'], Counter())
+        counts['ct'] += delta
+        for t in tags[c['key']]:
+            counts[TAG_PREFIX + t] += delta
+        total += delta
+        vocabulary.update(tags[c['key']])
+
+    # Deltas that cancelled out need no write; users with any change get
+    # a new version, which invalidates their cached recommendations
+    for userid in list(users):
+        users[userid] = Counter({n: d for n, d in users[userid].items() if d})
+        if users[userid]:
+            users[userid]['version'] = 1
+        else:
+            del users[userid]
+
+    return likes, users, total, vocabulary
+
+
+def get_tags(keys):
+    keys = list(keys)
+
+    tags = {}
+    # BatchGetItem reads at most 100 keys per request
+    for i in range(0, len(keys), 100):
+        request = {
+            METADATA_TABLE: {
+                'Keys': [{
+                    'UrlHash': k
+                } for k in keys[i:i + 100]],
+                'ProjectionExpression': 'UrlHash, tags'
+            }
+        }
+        while request:
+            response = get_dynamodb().batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(METADATA_TABLE, []):
+                tags[item['UrlHash']] = set(item.get('tags', []))
+            request = response.get('UnprocessedKeys')
+
+    return tags
+
+
+def update_item(table, key, exp, values, names=None):
+    params = {}
+    if names:
+        params['ExpressionAttributeNames'] = names
+
+    # The resource's client is thread-safe and still takes plain values
+    response = get_dynamodb().meta.client.update_item(
+        TableName=table,
+        Key={'key': key},
+        UpdateExpression=exp,
+        ExpressionAttributeValues=values,
+        ReturnValues='UPDATED_NEW',
+        **params)
+
+    print(response)
@@ -0,0 +1,53 @@
+import json
+import os
+import sys
+import time
+
+# Buffer the events in memory rather than sending them to SQS
+os.environ['HISTORY_INGEST_MODE'] = 'local'
+
+from index import get_queue, lambda_handler  # noqa: E402
+
+#
+# Replays click events through the handler outside AWS, as API Gateway
+# would deliver them, and applies them with LocalQueue. Each line of the
+# input file is a JSON object with userid, key and event, e.g.
+#
+#   {"userid": "u1", "key": "<UrlHash>", "event": "read"}
+#
+# The tables are the ones named by METADATA_TABLE and HISTORY_TABLE, so
+# point AWS_ENDPOINT_URL at DynamoDB Local to keep the run off AWS.
+#
+# Usage: python local.py <events file>
+#
+
+
+def replay(lines):
+    count = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        click = json.loads(line)
+        lambda_handler({
+            'headers': {'userid': click['userid']},
+            'body': json.dumps({'key': click['key'], 'event': click['event']})
+        }, None)
+        count += 1
+    return count
+
+
+def main(argv):
+    if not argv:
+        print('Error: Events file must be specified.')
+        return
+
+    start = time.time()
+    with open(argv[0]) as f:
+        count = replay(f)
+    get_queue().flush()
+
+    print(f'@main: applied {count} events in {time.time() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,12 +1,13 @@
 import json
 import os
+import random
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 from botocore.exceptions import ClientError
 
-from opensearchpy import OpenSearch, RequestsHttpConnection
-from requests_aws4auth import AWS4Auth
-
 REGION = os.environ['REGION']
 METADATA_TABLE = os.environ['METADATA_TABLE']
 HISTORY_TABLE = os.environ['HISTORY_TABLE']
@@ -14,14 +15,122 @@ HISTORY_TABLE = os.environ['HISTORY_TABLE']
 HOST = os.environ['OPENSEARCH_ENDPOINT']
 INDEX = os.environ['OPENSEARCH_INDEX']
 
+# Recommendations returned per page
+PAGE_SIZE = int(os.environ.get('RECOMMEND_PAGE_SIZE', '30'))
+
+# Per-user click counters written by api/history: one item per user,
+# keyed by the userid and the suffix, with an attribute per tag
+USER_CLICKS_SUFFIX = '#clicks'
+TAG_PREFIX = 'tag:'
+
+# Items the global click counter is spread over, and how long readers
+# reuse its total; must be the same in api/history and api/recommend
+COUNTER_SHARDS = int(os.environ.get('COUNTER_SHARDS', '10'))
+COUNTER_CACHE_TTL = int(os.environ.get('COUNTER_CACHE_TTL', '60'))
+
+# The first page of a user's recommendations is kept on the user's
+# '#recommend' item and reused until it expires, the user's history
+# changes (api/history bumps 'version' on the clicks item) or the indexer
+# adds an article with one of the tags it was searched for (counted per
+# tag on the versions item, and under 'all' for any article)
+RECOMMEND_CACHE_SUFFIX = '#recommend'
+RECOMMEND_CACHE_TTL = int(os.environ.get('RECOMMEND_CACHE_TTL', '3600'))
+VERSIONS_KEY = 'recommend#versions'
+ALL_ARTICLES = 'all'
+
+# Keys read by one BatchGetItem request, the DynamoDB maximum
+BATCH_GET_SIZE = 100
+
+
+# Created on first use and reused by warm invocations of the container
+_dynamodb = None
+_opensearch = None
+
+
+def get_dynamodb():
+    global _dynamodb
+    if _dynamodb is None:
+        _dynamodb = boto3.resource('dynamodb')
+    return _dynamodb
+
+
+def get_table(name):
+    return get_dynamodb().Table(name)
+
+
+class ShardedCounter:
+    # A counter spread over several items, '<name>#<shard>', so that the
+    # increments of a hot counter land on different partitions. Writers
+    # pick a shard at random; readers sum every shard and keep the total
+    # for ttl seconds.
+    def __init__(self, name, shards=COUNTER_SHARDS, ttl=COUNTER_CACHE_TTL):
+        self.name = name
+        self.shards = shards
+        self.ttl = ttl
+        self.total = None
+        self.expires = 0
+
+    def shard_key(self):
+        return '%s#%d' % (self.name, random.randrange(self.shards))
+
+    def keys(self):
+        # The unsharded item from before counters were sharded still counts
+        return [self.name] + [
+            '%s#%d' % (self.name, i) for i in range(self.shards)
+        ]
+
+    def fresh(self):
+        return self.total is not None and time.time() < self.expires
+
+    # Items of keys() already read along with other keys can be passed in
+    # to save a request
+    def value(self, items=None):
+        if self.fresh():
+            return self.total
+
+        if items is None:
+            items = batch_get_items(self.keys(), HISTORY_TABLE)
+
+        self.total = sum(items[k]['ct'] for k in self.keys() if k in items)
+        self.expires = time.time() + self.ttl
+        return self.total
+
+
+TOTAL_CLICKS = ShardedCounter('totalsum')
+
+
+def get_opensearch():
+    global _opensearch
+    if _opensearch is None:
+        # Imported here so that only invocations that search pay for it
+        from opensearchpy import OpenSearch, RequestsHttpConnection
+
+        _opensearch = OpenSearch(hosts=[{
+            'host': HOST,
+            'port': 443
+        }],
+                                 http_auth=get_awsauth(REGION, 'es'),
+                                 use_ssl=True,
+                                 verify_certs=True,
+                                 connection_class=RequestsHttpConnection)
+    return _opensearch
+
 
 def lambda_handler(event, context):
     print('Received event: ' + json.dumps(event))
 
     userid = event['headers']['userid']
+    page = get_page(event)
+
+    results = None
+    if page == 0:
+        results, versions = get_cached(userid)
 
-    top_tags = get_top_tags(userid)
-    results = query_results(top_tags)
+    if results is None:
+        top_tags = get_top_tags(userid)
+        results = query_results(top_tags, page)
+        if page == 0:
+            put_cached(userid, top_tags, results, versions)
     print(results)
 
     # TODO:
@@ -40,99 +149,127 @@ def lambda_handler(event, context):
     }
 
 
-def query_results(tags):
-    r = []
+def get_cached(userid):
+    key = userid + RECOMMEND_CACHE_SUFFIX
+    clicks_key = userid + USER_CLICKS_SUFFIX
+    items = batch_get_items([key, clicks_key, VERSIONS_KEY], HISTORY_TABLE)
 
+    # Current versions of everything a cached list can depend on; read
+    # before recomputing, so a change made meanwhile is never hidden
+    versions = dict(items.get(VERSIONS_KEY, {}))
+    versions.pop('key', None)
+    versions['user'] = items.get(clicks_key, {}).get('version', 0)
+
+    cached = items.get(key)
+    if cached is None or cached['expires'] < time.time():
+        return None, versions
+
+    for name, version in cached['versions'].items():
+        if versions.get(name, 0) != version:
+            return None, versions
+
+    print('@get_cached: hit for', userid)
+    return json.loads(cached['results']), versions
+
+
+def put_cached(userid, tags, results, versions):
+    # The results depend on the tags the query was built from, or on every
+    # article when it fell back to the latest ones
+    tags = query_tags(tags)
+    names = ['user'] + [TAG_PREFIX + t for t, _ in tags]
     if len(tags) == 0:
-        hits = query_latest()
-        for hit in hits:
-            r.append({
-                'title': hit['title'],
-                'key': hit['UrlHash'],
-                'tags': hit['tags']
-            })
-
-    for t in tags:
-        hits = query(t)
-        for hit in hits:
-            r.append({
-                'title': hit['title'],
-                'key': hit['UrlHash'],
-                'tags': hit['tags']
-            })
-
-    return r
+        names.append(ALL_ARTICLES)
 
+    get_table(HISTORY_TABLE).put_item(
+        Item={
+            'key': userid + RECOMMEND_CACHE_SUFFIX,
+            'results': json.dumps(results),
+            'versions': {n: versions.get(n, 0) for n in names},
+            'expires': int(time.time()) + RECOMMEND_CACHE_TTL
+        })
 
-def get_awsauth(region, service):
-    cred = boto3.Session().get_credentials()
-    return AWS4Auth(cred.access_key,
-                    cred.secret_key,
-                    region,
-                    service,
-                    session_token=cred.token)
 
+def get_page(event):
+    params = event.get('queryStringParameters') or {}
+    try:
+        return max(int(params.get('page', 0)), 0)
+    except ValueError:
+        return 0
 
-def query(term):
-    q = {
-        'size': 30,
-        'query': {
-            'multi_match': {
-                'query': term,
-                'fields': ['tags']
-            }
-        }
-    }
 
-    client = OpenSearch(hosts=[{
-        'host': HOST,
-        'port': 443
-    }],
-                        http_auth=get_awsauth(REGION, 'es'),
-                        use_ssl=True,
-                        verify_certs=True,
-                        connection_class=RequestsHttpConnection)
+def query_results(tags, page=0):
+    q = build_query(tags)
+    q['from'] = page * PAGE_SIZE
+    q['size'] = PAGE_SIZE
+
+    client = get_opensearch()
 
     res = client.search(index=INDEX, body=q)
     print(res)
     hits = res['hits']['hits']
     results = []
 
+    # Documents are indexed under their UrlHash, so articles matching
+    # several tags come back once
     for hit in hits:
-        results.append(hit['_source'])
+        source = hit['_source']
+        results.append({
+            'title': source['title'],
+            'key': source['UrlHash'],
+            'tags': source['tags']
+        })
 
     return results
 
 
-def query_latest():
-    q = {
-        'size': 20,
-        'fields': ['timestamp'],
-        'sort': [{
-            'timestamp': {
-                'order': 'desc'
+def query_tags(tags):
+    # A tag without interest would get a zero or negative boost, which
+    # OpenSearch rejects or uses to rank its articles down
+    return [(t, i) for t, i in tags if i > 0]
+
+
+def build_query(tags):
+    tags = query_tags(tags)
+
+    # Latest articles for users without a history
+    if len(tags) == 0:
+        return {
+            'query': {
+                'match_all': {}
+            },
+            'sort': [{
+                'timestamp': {
+                    'order': 'desc'
+                }
+            }]
+        }
+
+    # One query for all tags, each weighted by the user's interest in it
+    # relative to the strongest one
+    top = max(i for _, i in tags)
+    should = []
+    for t, i in tags:
+        should.append({'match': {'tags': {'query': t, 'boost': i / top}}})
+
+    return {
+        'query': {
+            'bool': {
+                'should': should,
+                'minimum_should_match': 1
             }
-        }]
+        }
     }
 
-    client = OpenSearch(hosts=[{
-        'host': HOST,
-        'port': 443
-    }],
-                        http_auth=get_awsauth(REGION, 'es'),
-                        use_ssl=True,
-                        verify_certs=True,
-                        connection_class=RequestsHttpConnection)
 
-    res = client.search(index=INDEX, body=q)
-    print(res)
-    hits = res['hits']['hits']
-    results = []
-
-    for hit in hits:
-        results.append(hit['_source'])
+def get_awsauth(region, service):
+    from requests_aws4auth import AWS4Auth
 
-    return results
+    # The cached client can outlive the role's temporary credentials;
+    # AWS4Auth reads the current ones from the session for every request
+    cred = boto3.Session().get_credentials()
+    return AWS4Auth(region=region,
+                    service=service,
+                    refreshable_credentials=cred)
 
 
 def get_top_tags(userid):
@@ -143,12 +280,7 @@ def get_top_tags(userid):
     it.sort(key=lambda tup: tup[1], reverse=True)
     print(it)
 
-    it = it[:3]
-    ret = []
-    for i in it:
-        ret.append(i[0])
-
-    return ret
+    return it[:3]
 
 
 def calc_interest(userid):
@@ -166,7 +298,8 @@ def calc_interest(userid):
         i = float(c[1]) / float(total)
         cat_by_total.append((c[0], i))
 
-    pt_click = total / totalsum
+    # The cached total can trail the user's own clicks
+    pt_click = total / max(totalsum, total)
     pt_click = float(pt_click)
 
     interest = []
@@ -179,35 +312,68 @@ def calc_interest(userid):
 
 
 def get_clicks(userid):
-    res = get_item({'key': 'tags'}, HISTORY_TABLE)
-    tags = []
-    if 'Item' in res:
-        tags = res['Item']['tags']
-
-    print(tags)
+    # The user's counters and, unless cached, the shards of the total in
+    # one request, however many tags there are
+    key = userid + USER_CLICKS_SUFFIX
+    keys = [key]
+    if not TOTAL_CLICKS.fresh():
+        keys.extend(TOTAL_CLICKS.keys())
+    items = batch_get_items(keys, HISTORY_TABLE)
 
     clicks = []
-    for t in tags:
-        res = get_item({'key': userid + t}, HISTORY_TABLE)
-        if 'Item' in res:
-            c = res['Item']['ct']
-            clicks.append((t, c))
+    for name, c in items.get(key, {}).items():
+        if name.startswith(TAG_PREFIX):
+            clicks.append((name[len(TAG_PREFIX):], c))
 
     print(clicks)
 
-    total_clicks = 0
-    res = get_item({'key': 'totalsum'}, HISTORY_TABLE)
-    if 'Item' in res:
-        total_clicks = res['Item']['ct']
+    total_clicks = TOTAL_CLICKS.value(items)
 
     print(total_clicks)
 
     return clicks, total_clicks
 
 
+def batch_get_items(keys, table):
+    # BatchGetItem rejects requests with duplicate keys
+    keys = list(dict.fromkeys(keys))
+    chunks = [
+        keys[i:i + BATCH_GET_SIZE]
+        for i in range(0, len(keys), BATCH_GET_SIZE)
+    ]
+
+    if len(chunks) < 2:
+        return batch_get(keys, table) if keys else {}
+
+    items = {}
+    with ThreadPoolExecutor(max_workers=min(len(chunks), 8)) as executor:
+        for found in executor.map(lambda c: batch_get(c, table), chunks):
+            items.update(found)
+
+    return items
+
+
+def batch_get(keys, table):
+    request = {table: {'Keys': [{'key': k} for k in keys]}}
+
+    # The low-level client, unlike the resource, is safe to share between
+    # the threads of batch_get_items; the resource's client still converts
+    # the attribute values
+    client = get_dynamodb().meta.client
+
+    items = {}
+    while request:
+        response = client.batch_get_item(RequestItems=request)
+        for item in response['Responses'].get(table, []):
+            items[item['key']] = item
+        request = response.get('UnprocessedKeys')
+
+    print('@batch_get: read', len(items), 'of', len(keys), 'items')
+    return items
+
+
 def get_top_results():
-    db = boto3.resource('dynamodb')
-    table = db.Table(METADATA_TABLE)
+    table = get_table(METADATA_TABLE)
 
     response = table.scan(TableName=METADATA_TABLE, Limit=10)
     print('@scan: response', response)
@@ -215,8 +381,7 @@ def get_top_results():
 
 
 def get_item(key, table):
-    db = boto3.resource('dynamodb')
-    table = db.Table(table)
+    table = get_table(table)
 
     try:
         response = table.get_item(Key=key)
@@ -9,6 +9,17 @@ METADATA_TABLE = os.environ['METADATA_TABLE']
 HISTORY_TABLE = os.environ['HISTORY_TABLE']
 
 
+# Created on first use and reused by warm invocations of the container
+_dynamodb = None
+
+
+def get_table(name):
+    global _dynamodb
+    if _dynamodb is None:
+        _dynamodb = boto3.resource('dynamodb')
+    return _dynamodb.Table(name)
+
+
 def lambda_handler(event, context):
     print('Received event: ' + json.dumps(event))
 
@@ -44,8 +55,7 @@ def lambda_handler(event, context):
 
 
 def get_item(key, table):
-    db = boto3.resource('dynamodb')
-    table = db.Table(table)
+    table = get_table(table)
 
     try:
         response = table.get_item(Key=key)
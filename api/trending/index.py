@@ -4,9 +4,6 @@ import os
 import boto3
 from botocore.exceptions import ClientError
 
-from opensearchpy import OpenSearch, RequestsHttpConnection
-from requests_aws4auth import AWS4Auth
-
 REGION = os.environ['REGION']
 METADATA_TABLE = os.environ['METADATA_TABLE']
 
@@ -14,6 +11,35 @@ HOST = os.environ['OPENSEARCH_ENDPOINT']
 INDEX = os.environ['OPENSEARCH_INDEX']
 
 
+# Created on first use and reused by warm invocations of the container
+_dynamodb = None
+_opensearch = None
+
+
+def get_table(name):
+    global _dynamodb
+    if _dynamodb is None:
+        _dynamodb = boto3.resource('dynamodb')
+    return _dynamodb.Table(name)
+
+
+def get_opensearch():
+    global _opensearch
+    if _opensearch is None:
+        # Imported here so that only invocations that search pay for it
+        from opensearchpy import OpenSearch, RequestsHttpConnection
+
+        _opensearch = OpenSearch(hosts=[{
+            'host': HOST,
+            'port': 443
+        }],
+                                 http_auth=get_awsauth(REGION, 'es'),
+                                 use_ssl=True,
+                                 verify_certs=True,
+                                 connection_class=RequestsHttpConnection)
+    return _opensearch
+
+
 def lambda_handler(event, context):
     print('Received event: ' + json.dumps(event))
 
@@ -40,12 +66,14 @@ def lambda_handler(event, context):
 
 
 def get_awsauth(region, service):
+    from requests_aws4auth import AWS4Auth
+
+    # The cached client can outlive the role's temporary credentials;
+    # AWS4Auth reads the current ones from the session for every request
     cred = boto3.Session().get_credentials()
-    return AWS4Auth(cred.access_key,
-                    cred.secret_key,
-                    region,
-                    service,
-                    session_token=cred.token)
+    return AWS4Auth(region=region,
+                    service=service,
+                    refreshable_credentials=cred)
 
 
 def query():
@@ -59,14 +87,7 @@ def query():
         }]
     }
 
-    client = OpenSearch(hosts=[{
-        'host': HOST,
-        'port': 443
-    }],
-                        http_auth=get_awsauth(REGION, 'es'),
-                        use_ssl=True,
-                        verify_certs=True,
-                        connection_class=RequestsHttpConnection)
+    client = get_opensearch()
 
     res = client.search(index=INDEX, body=q)
     print(res)
@@ -80,8 +101,7 @@ def query():
 
 
 def get_top_results():
-    db = boto3.resource('dynamodb')
-    table = db.Table(METADATA_TABLE)
+    table = get_table(METADATA_TABLE)
 
     response = table.scan(TableName=METADATA_TABLE, Limit=10)
     print('@scan: response', response)
@@ -89,8 +109,7 @@ def get_top_results():
 
 
 def get_item(key, table):
-    db = boto3.resource('dynamodb')
-    table = db.Table(table)
+    table = get_table(table)
 
     try:
         response = table.get_item(Key=key)
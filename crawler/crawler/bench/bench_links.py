@@ -0,0 +1,116 @@
+import os
+import random
+import sys
+import time
+
+from playwright.sync_api import sync_playwright
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from common import CrawlInput  # noqa: E402
+from core import get_links  # noqa: E402
+from utils import (normalize_url, url_has_any_path,  # noqa: E402
+                   url_is_from_any_domain)
+
+#
+# Link harvesting of one rendered page: one evaluate() round-trip per
+# anchor, as get_links used to do, against the single
+# eval_on_selector_all of get_links. The page is a saved Google News page
+# loaded with set_content, or a generated one shaped like a topic page.
+#
+# Usage: python bench/bench_links.py [page.html] [repeat]
+#
+# BENCH_BROWSER_PATH points at a Chromium binary to use instead of the one
+# installed by playwright.
+#
+
+BASE_URL = 'https://news.google.com/'
+TARGET_DOMAINS = ['news.google.com']
+TARGET_PATHS = ['/articles/', '/topics/', '/stories/']
+
+
+def topic_page(stories=150, seed=1):
+    # Each story links its headline, its image and a few related stories,
+    # besides the navigation and footer links of every page
+    rng = random.Random(seed)
+    links = [f'<a href="./topics/{i:04d}?hl=en-US">Topic {i}</a>'
+             for i in range(60)]
+    for _ in range(stories):
+        n = rng.getrandbits(48)
+        article = f'./articles/CBMi{n:012x}?hl=en-US&gl=US&ceid=US:en'
+        links.append(f'<a href="{article}"><img alt=""></a>')
+        links.append(f'<a href="{article}">Headline {n:x}</a>')
+        links.append(f'<a href="https://publisher{n % 40}.com/">Source</a>')
+        for _ in range(rng.randrange(3)):
+            links.append(f'<a href="./stories/{rng.getrandbits(48):x}">'
+                         'Full coverage</a>')
+    links += [f'<a href="https://support.google.com/{i}">Help</a>'
+              for i in range(20)]
+    return '<html><body>' + '\n'.join(links) + '</body></html>'
+
+
+def old_links(page, crawl_input):
+    atags = page.locator('a')
+    urls = set()
+
+    for i in range(atags.count()):
+        href = atags.nth(i).evaluate('node => node.href')
+        if not isinstance(href, str):
+            continue
+
+        url = normalize_url(href)
+        if (url_is_from_any_domain(url, crawl_input.target_domains) and
+                url_has_any_path(url, crawl_input.target_paths)):
+            urls.add(url)
+
+    return urls
+
+
+def run(name, func, page, crawl_input, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        urls = func(page, crawl_input)
+        spent = time.perf_counter() - start
+        best = spent if best is None else min(best, spent)
+    print(f'{name:<24} {best * 1000:8.1f} ms/page')
+    return best, set(urls)
+
+
+def main(argv):
+    if argv:
+        with open(argv[0], encoding='utf-8') as f:
+            html = f.read()
+    else:
+        html = topic_page()
+    repeat = int(argv[1]) if len(argv) > 1 else 5
+
+    # Relative hrefs resolve as they would on news.google.com
+    html = html.replace('<head>', f'<head><base href="{BASE_URL}">', 1)
+    if '<base ' not in html:
+        html = f'<base href="{BASE_URL}">' + html
+
+    crawl_input = CrawlInput('bench', [], TARGET_DOMAINS, TARGET_PATHS)
+
+    with sync_playwright() as pw:
+        browser = pw.chromium.launch(
+            headless=True,
+            executable_path=os.environ.get('BENCH_BROWSER_PATH'))
+        page = browser.new_page()
+        page.set_content(html)
+        anchors = page.locator('a').count()
+
+        print(f'{anchors} anchors, best of {repeat}')
+        (old, old_urls) = run('evaluate per anchor', old_links, page,
+                              crawl_input, repeat)
+        (new, new_urls) = run('eval_on_selector_all', get_links, page,
+                              crawl_input, repeat)
+        browser.close()
+
+    # Both must find the same links before their timings mean anything
+    assert old_urls == new_urls, (len(old_urls), len(new_urls))
+    print(f'{"":<24} {old / new:8.1f}x, {len(new_urls)} links kept')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
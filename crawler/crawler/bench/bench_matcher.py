@@ -0,0 +1,88 @@
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from s3 import WHITELIST, WHITELIST_MATCHER  # noqa: E402
+from utils import (UrlMatcher, url_has_any_path,  # noqa: E402
+                   url_is_from_any_domain)
+
+#
+# Per-url cost of the compiled UrlMatcher against the url_is_from_any_domain
+# and url_has_any_path scans it replaced, over a generated corpus shaped
+# like the links of a Google News page: mostly news.google.com article
+# links plus publisher, ad and tracking hosts.
+#
+# Usage: python bench/bench_matcher.py [urls] [repeat]
+#
+
+TARGET_DOMAINS = ['news.google.com']
+TARGET_PATHS = ['/articles/', '/topics/', '/stories/']
+
+OTHER_HOSTS = [
+    'www.google.com', 'accounts.google.com', 'support.google.com',
+    'play.google.com', 'www.youtube.com', 'doubleclick.net',
+    'ads.example.org', 'cdn.example.net', 'www.bbc.co.uk',
+    'edition.cnn.com', 'www.reuters.com', 'sports.yahoo.com'
+] + ['www.' + d for d in WHITELIST]
+
+PATHS = ['/articles/', '/topics/', '/stories/', '/search', '/settings/',
+         '/2023/01/05/world/', '/news/', '/']
+
+
+def corpus(n, seed=1):
+    rng = random.Random(seed)
+    urls = []
+    for i in range(n):
+        if rng.random() < 0.6:
+            host = 'news.google.com'
+        else:
+            host = rng.choice(OTHER_HOSTS)
+        path = rng.choice(PATHS) + '%x' % rng.getrandbits(64)
+        urls.append(f'https://{host}{path}?hl=en-US&gl=US&ceid=US:en')
+    return urls
+
+
+def old_filter(url):
+    return (url_is_from_any_domain(url, TARGET_DOMAINS) and
+            url_has_any_path(url, TARGET_PATHS))
+
+
+def old_whitelist(url):
+    return url_is_from_any_domain(url, WHITELIST)
+
+
+def run(name, func, urls, repeat):
+    best = min(
+        timeit.repeat(lambda: [func(u) for u in urls], number=1,
+                      repeat=repeat))
+    print(f'{name:<24} {best / len(urls) * 1e6:8.2f} us/url')
+    return best
+
+
+def main(argv):
+    n = int(argv[0]) if argv else 100000
+    repeat = int(argv[1]) if len(argv) > 1 else 5
+    urls = corpus(n)
+
+    matcher = UrlMatcher(TARGET_DOMAINS, TARGET_PATHS)
+
+    # Both implementations must agree before their timings mean anything
+    assert [old_filter(u) for u in urls] == [matcher.matches(u) for u in urls]
+    assert ([old_whitelist(u) for u in urls] ==
+            [WHITELIST_MATCHER.matches(u) for u in urls])
+
+    print(f'{n} urls, best of {repeat}')
+    old = run('filter: domain+path scan', old_filter, urls, repeat)
+    new = run('filter: UrlMatcher', matcher.matches, urls, repeat)
+    print(f'{"":<24} {old / new:8.1f}x')
+    old = run('whitelist: domain scan', old_whitelist, urls, repeat)
+    new = run('whitelist: UrlMatcher', WHITELIST_MATCHER.matches, urls,
+              repeat)
+    print(f'{"":<24} {old / new:8.1f}x')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
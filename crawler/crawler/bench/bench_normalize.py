@@ -0,0 +1,91 @@
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from utils import canonical_url, get_hash, normalize_url  # noqa: E402
+
+#
+# CPU spent per crawled page on url normalization and hashing, before and
+# after canonical_url's cache, over a generated link dump shaped like
+# Google News: every page repeats the same navigation links, and article
+# links recur across topic pages with a long tail of one-off links.
+#
+# Usage: python bench/bench_normalize.py [pages] [links per page]
+#
+
+NAV_LINKS = 120
+TOP_STORIES = 500
+ARTICLES = 50000
+
+
+def link_dump(pages, links, seed=1):
+    rng = random.Random(seed)
+    nav = [
+        f'https://news.google.com/topics/{i:04d}?hl=en-US&gl=US&ceid=US:en'
+        for i in range(NAV_LINKS)
+    ]
+
+    dump = []
+    for _ in range(pages):
+        hrefs = list(nav)
+        while len(hrefs) < links:
+            # Half the links go to the day's top stories, which many pages
+            # share; the rest to a long tail of articles
+            if rng.random() < 0.5:
+                n = rng.randrange(TOP_STORIES)
+            else:
+                n = rng.randrange(ARTICLES)
+            hrefs.append(f'./articles/CBMi{n:08x}?hl=en-US&gl=US&ceid=US:en')
+        rng.shuffle(hrefs)
+        page_url = f'https://news.google.com/articles/CBMi{len(dump):08x}'
+        dump.append((page_url, [
+            h.replace('./', 'https://news.google.com/') for h in hrefs
+        ]))
+    return dump
+
+
+def uncached(dump):
+    for (page_url, hrefs) in dump:
+        # filter_links / enqueue
+        for h in hrefs:
+            get_hash(normalize_url(h))
+        # real_url of the visited page, then the S3 key before saving
+        nurl = normalize_url(page_url)
+        get_hash(nurl)
+        get_hash(normalize_url(nurl))
+
+
+def cached(dump):
+    canonical_url.cache_clear()
+    for (page_url, hrefs) in dump:
+        for h in hrefs:
+            canonical_url(h)
+        canonical_url(page_url)
+
+
+def run(name, func, dump):
+    start = time.process_time()
+    func(dump)
+    spent = time.process_time() - start
+    print(f'{name:<10} {spent / len(dump) * 1000:8.2f} ms CPU/page')
+    return spent
+
+
+def main(argv):
+    pages = int(argv[0]) if argv else 500
+    links = int(argv[1]) if len(argv) > 1 else 300
+    dump = link_dump(pages, links)
+
+    print(f'{pages} pages, {links} links per page')
+    old = run('uncached', uncached, dump)
+    new = run('cached', cached, dump)
+    info = canonical_url.cache_info()
+    print(f'{"":<10} {old / new:8.1f}x, cache hit rate '
+          f'{info.hits / (info.hits + info.misses):.0%}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
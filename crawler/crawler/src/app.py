@@ -1,20 +1,24 @@
+import asyncio
 import json
 
 from playwright.sync_api import sync_playwright
 
 from utils import create_crawl_input
-from local import crawl
+from local import CONCURRENCY, crawl, run_async
 
 
 def main():
     crawl_input = create_crawl_input('./src/crawl_input.txt')
 
-    with sync_playwright() as pw:
-        print('Opening browser..')
-        browser = pw.chromium.launch(headless=True)
-        print('Browser opened..')
-        crawl(browser, crawl_input)
-        browser.close()
+    if CONCURRENCY > 1:
+        asyncio.run(run_async(crawl_input))
+    else:
+        with sync_playwright() as pw:
+            print('Opening browser..')
+            browser = pw.chromium.launch(headless=True)
+            print('Browser opened..')
+            crawl(browser, crawl_input)
+            browser.close()
 
     message = 'Hello World! Playwright!'
     return message
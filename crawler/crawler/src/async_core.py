@@ -0,0 +1,70 @@
+from common import CrawlOutput, CrawlStatus, PageContent
+from core import (EXCLUDED_RESOURCE_TYPES, GOTO_TIMEOUT, LINKS_SCRIPT,
+                  crawl_error, filter_links)
+from render import wait_for_render_async
+
+#
+# Async counterparts of the functions in core.py, built on
+# playwright.async_api so that many pages can be rendered concurrently
+# from a single browser.
+#
+
+
+async def block_aggressively(route):
+    if route.request.resource_type in EXCLUDED_RESOURCE_TYPES:
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+async def get_links(page, crawl_input):
+    hrefs = await page.eval_on_selector_all('a', LINKS_SCRIPT)
+    return filter_links(hrefs, crawl_input)
+
+
+async def extract_content(page):
+    title = await page.locator('title').nth(0).inner_text()
+    return PageContent(
+        title=title,
+        html_content=await page.content(),
+    )
+
+
+async def extract_page_content_and_urls(pool,
+                                        url,
+                                        crawl_input,
+                                        profile=None):
+    slot = None
+    try:
+        slot = await pool.acquire()
+        page = slot.page
+
+        response = await page.goto(url,
+                                   timeout=GOTO_TIMEOUT,
+                                   wait_until='load')
+        print('Page loaded...')
+
+        status = CrawlStatus(
+            code=response.status,
+            text=response.status_text,
+        )
+
+        # Same render wait as the sync crawler
+        await wait_for_render_async(page, profile)
+        print('Page rendering...')
+
+        output = CrawlOutput(status=status,
+                             content=await extract_content(page),
+                             new_urls=await get_links(page, crawl_input),
+                             url=url,
+                             real_url=page.url,
+                             err=None)
+
+        await pool.release(slot)
+
+        return output
+    except Exception as except_obj:
+        if slot is not None:
+            await pool.release(slot, failed=True)
+
+        return crawl_error(url, except_obj)
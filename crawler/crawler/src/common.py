@@ -1,5 +1,5 @@
 # from dataclasses import dataclass
-from typing import NamedTuple, List
+from typing import Any, List, NamedTuple, Set
 
 # @dataclass
 # class Address:
@@ -36,3 +36,10 @@ class CrawlOutput(NamedTuple):
     url: str
     real_url: str
     err: CrawlErr
+
+
+class CrawlState(NamedTuple):
+    frontier: Any
+    seen_urls: Set[bytes]
+    known_urls: Any
+    start_urls: Set[str]
@@ -1,38 +1,46 @@
 import traceback
 
 from common import CrawlErr, CrawlOutput, CrawlStatus, PageContent
-from utils import normalize_url, url_is_from_any_domain, url_has_any_path
+from render import wait_for_render
+from utils import canonical_url, compile_matcher
 
+EXCLUDED_RESOURCE_TYPES = ['stylesheet', 'image', 'font']
+VIEWPORT = {'width': 1920, 'height': 1080}
+GOTO_TIMEOUT = 10000
+LINKS_SCRIPT = 'nodes => nodes.map(node => node.href)'
 
-def block_aggressively(route):
-    excluded_resource_types = ['stylesheet', 'image', 'font']
 
-    if route.request.resource_type in excluded_resource_types:
+def block_aggressively(route):
+    if route.request.resource_type in EXCLUDED_RESOURCE_TYPES:
         route.abort()
     else:
         route.continue_()
 
 
-def get_links(page, crawl_input):
-    atags = page.locator('a')
-    urls = set()
+def filter_links(hrefs, crawl_input):
+    matcher = compile_matcher(tuple(crawl_input.target_domains),
+                              tuple(crawl_input.target_paths))
 
-    for i in range(atags.count()):
-        el = atags.nth(i)
-        href = el.evaluate('node => node.href')
-        if not isinstance(href, str):
-            continue
+    # Keep document order; stories listed first are the most prominent
+    urls = {}
 
+    # Pages link to the same article many times; normalize each href once
+    for href in dict.fromkeys(h for h in hrefs if isinstance(h, str)):
         # Filter to only urls within our target domains/paths
-        url = normalize_url(href)
-        if (url_is_from_any_domain(url, crawl_input.target_domains) and
-                url_has_any_path(url, crawl_input.target_paths)):
-            urls.add(url)
+        (url, _) = canonical_url(href)
+        if matcher.matches(url):
+            urls[url] = None
 
     # TODO:
     #       Check if we need to convert relative urls to absolute
 
-    return urls
+    return list(urls)
+
+
+def get_links(page, crawl_input):
+    # Collect every href in a single round-trip to the browser
+    hrefs = page.eval_on_selector_all('a', LINKS_SCRIPT)
+    return filter_links(hrefs, crawl_input)
 
 
 def extract_content(page):
@@ -43,17 +51,29 @@ def extract_content(page):
     )
 
 
-def extract_page_content_and_urls(browser, url, crawl_input):
-    try:
-        context = browser.new_context(viewport={'width': 1920, 'height': 1080})
-        page = context.new_page()
+def crawl_error(url, except_obj):
+    err = CrawlErr(
+        err=str(except_obj),
+        trace=traceback.format_exc(),
+    )
 
-        # TODO:
-        #       add user-agent to the context
-        #
+    return CrawlOutput(
+        status=None,
+        content=None,
+        new_urls=None,
+        url=url,
+        real_url=None,
+        err=err,
+    )
+
+
+def extract_page_content_and_urls(pool, url, crawl_input, profile=None):
+    slot = None
+    try:
+        slot = pool.acquire()
+        page = slot.page
 
-        page.route('**/*', block_aggressively)
-        response = page.goto(url, timeout=10000, wait_until='load')
+        response = page.goto(url, timeout=GOTO_TIMEOUT, wait_until='load')
         print('Page loaded...')
 
         status = CrawlStatus(
@@ -61,9 +81,9 @@ def extract_page_content_and_urls(browser, url, crawl_input):
             text=response.status_text,
         )
 
-        # Wait 2000ms, a reasonable time for js libraries to load and
-        # complete client-side rendering or ajax calls
-        page.wait_for_timeout(2000)
+        # Give js libraries time to complete client-side rendering or ajax
+        # calls; the wait is learned per domain when a profile is given
+        wait_for_render(page, profile)
         print('Page rendering...')
 
         output = CrawlOutput(status=status,
@@ -73,22 +93,11 @@ def extract_page_content_and_urls(browser, url, crawl_input):
                              real_url=page.url,
                              err=None)
 
-        context.close()
+        pool.release(slot)
 
         return output
     except Exception as except_obj:
-        context.close()
+        if slot is not None:
+            pool.release(slot, failed=True)
 
-        err = CrawlErr(
-            err=str(except_obj),
-            trace=traceback.format_exc(),
-        )
-
-        return CrawlOutput(
-            status=None,
-            content=None,
-            new_urls=None,
-            url=url,
-            real_url=None,
-            err=err,
-        )
+        return crawl_error(url, except_obj)
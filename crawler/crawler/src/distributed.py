@@ -0,0 +1,384 @@
+import abc
+import os
+import sqlite3
+import time
+
+from collections import Counter
+
+import boto3
+from botocore.exceptions import ClientError
+
+from frontier import Frontier
+from utils import canonical_url, get_digest, parse_url
+
+# Worker layout of a distributed crawl; every worker runs local.py with the
+# same CRAWL_WORKERS and CRAWL_RUN_ID and its own CRAWL_WORKER_ID. The run
+# id has no default: it must be shared by the workers of a run and differ
+# between runs, including retries.
+WORKERS = int(os.environ.get('CRAWL_WORKERS', '1'))
+WORKER_ID = int(os.environ.get('CRAWL_WORKER_ID', '0'))
+RUN_ID = os.environ.get('CRAWL_RUN_ID')
+
+# Where workers coordinate: 'dynamodb' (the crawl-queue and crawl-history
+# tables, for workers on separate machines) or 'sqlite' (a local file,
+# for workers on one machine)
+SHARED_BACKEND = os.environ.get('CRAWL_SHARED_BACKEND', 'dynamodb')
+SHARED_STORE_PATH = os.environ.get('CRAWL_SHARED_STORE', './crawl_shared.db')
+QUEUE_TABLE = os.environ.get('CRAWL_QUEUE_TABLE', 'crawl-queue')
+HISTORY_TABLE = os.environ.get('CRAWL_HISTORY_TABLE', 'crawl-history')
+# Queue entries and claims of a run expire after this many seconds
+ENTRY_TTL = 2 * 24 * 3600
+# Polls after which a queue entry that was numbered but never written is
+# given up on, e.g. because its writer died in between
+MAX_MISSING_POLLS = 30
+
+# 'host' keeps every url of a host on one worker so politeness holds
+# globally; 'url' spreads single-host inputs such as news.google.com
+SHARD_KEY = os.environ.get('CRAWL_SHARD_KEY', 'url')
+
+# A worker with nothing to do polls the shared queue and gives up after
+# this many idle seconds
+POLL_INTERVAL = 1.0
+IDLE_TIMEOUT = float(os.environ.get('CRAWL_IDLE_TIMEOUT', '60'))
+
+
+def shard_of(url, workers, key=SHARD_KEY):
+    if key == 'host':
+        url = parse_url(url).netloc.lower()
+    return int.from_bytes(get_digest(url)[:4], 'big') % workers
+
+
+def get_shared_store(backend=SHARED_BACKEND, run_id=RUN_ID):
+    if not run_id:
+        raise ValueError('CRAWL_RUN_ID must be set for a distributed crawl')
+
+    if backend == 'dynamodb':
+        return DynamoDBStore(run_id)
+    if backend == 'sqlite':
+        return SQLiteStore(run_id=run_id)
+    raise ValueError(f'Unknown shared store backend {backend!r}')
+
+
+class SharedStore(abc.ABC):
+    #
+    # Coordination point of a distributed crawl: one queue of urls per
+    # shard, a per-run claim table so each url is crawled by a single
+    # worker, and the set of urls visited by previous runs.
+    #
+
+    @abc.abstractmethod
+    def claim(self, digest):
+        pass
+
+    @abc.abstractmethod
+    def push(self, shard, tag, url, depth):
+        pass
+
+    @abc.abstractmethod
+    def pop_all(self, shard):
+        pass
+
+    @abc.abstractmethod
+    def is_known(self, digest):
+        pass
+
+    # Those of the digests visited by previous runs, in as few requests
+    # as the backend allows
+    @abc.abstractmethod
+    def known(self, digests):
+        pass
+
+    @abc.abstractmethod
+    def add_known(self, digest):
+        pass
+
+
+class DynamoDBStore(SharedStore):
+    #
+    # SharedStore on the crawl-queue and crawl-history tables. Both are
+    # keyed by a single UrlHash string, so crawl-queue holds prefixed keys:
+    # '<run>#claim#<digest>' for claims, and for each shard a counter item
+    # '<run>#seq#<shard>' numbering the queue entries
+    # '<run>#queue#<shard>#<n>'. Only the owner of a shard reads its
+    # entries, so it just remembers the next number to read.
+    #
+
+    def __init__(self,
+                 run_id=RUN_ID,
+                 queue_table=QUEUE_TABLE,
+                 history_table=HISTORY_TABLE):
+        self.run_id = run_id
+        self.dynamodb = boto3.resource('dynamodb')
+        self.queue = self.dynamodb.Table(queue_table)
+        self.history = self.dynamodb.Table(history_table)
+        self.expires = int(time.time()) + ENTRY_TTL
+        self.cursor = {}
+        self.missing = {}
+
+    def key(self, *parts):
+        return '#'.join([self.run_id, *map(str, parts)])
+
+    def claim(self, digest):
+        try:
+            self.queue.put_item(
+                Item={
+                    'UrlHash': self.key('claim', digest.hex()),
+                    'expires': self.expires
+                },
+                ConditionExpression='attribute_not_exists(UrlHash)')
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    def push(self, shard, tag, url, depth):
+        res = self.queue.update_item(
+            Key={'UrlHash': self.key('seq', shard)},
+            UpdateExpression='ADD seq :one SET expires = :expires',
+            ExpressionAttributeValues={
+                ':one': 1,
+                ':expires': self.expires
+            },
+            ReturnValues='UPDATED_NEW')
+        n = int(res['Attributes']['seq'])
+
+        self.queue.put_item(
+            Item={
+                'UrlHash': self.key('queue', shard, n),
+                'tag': tag,
+                'url': url,
+                'depth': depth,
+                'expires': self.expires
+            })
+
+    def pop_all(self, shard):
+        res = self.queue.get_item(Key={'UrlHash': self.key('seq', shard)},
+                                  ConsistentRead=True)
+        last = int(res.get('Item', {}).get('seq', 0))
+
+        # Entries may be numbered by their writer but not written yet
+        missing = self.missing.setdefault(shard, {})
+        start = self.cursor.get(shard, 1)
+        numbers = list(missing) + list(range(start, last + 1))
+        if not numbers:
+            return []
+
+        keys = [{'UrlHash': self.key('queue', shard, n)} for n in numbers]
+        found = {
+            int(item['UrlHash'].rsplit('#', 1)[1]): item
+            for item in self.batch_get(self.queue, keys, ConsistentRead=True)
+        }
+
+        # Only moved on once the entries were read, so a failed poll is
+        # repeated by the next one
+        self.cursor[shard] = max(start, last + 1)
+        for n in numbers:
+            if n in found:
+                missing.pop(n, None)
+            elif missing.get(n, 0) < MAX_MISSING_POLLS:
+                missing[n] = missing.get(n, 0) + 1
+            else:
+                del missing[n]
+
+        try:
+            with self.queue.batch_writer() as batch:
+                for n in found:
+                    batch.delete_item(
+                        Key={'UrlHash': self.key('queue', shard, n)})
+        except ClientError as e:
+            # Read entries are not read again; the rest expire
+            print('Could not delete queue entries:', e)
+
+        return [(item['tag'], item['url'], int(item['depth']))
+                for _, item in sorted(found.items())]
+
+    def batch_get(self, table, keys, **params):
+        items = []
+        for i in range(0, len(keys), 100):
+            request = {table.name: {'Keys': keys[i:i + 100], **params}}
+            while request:
+                response = self.dynamodb.batch_get_item(RequestItems=request)
+                items.extend(response['Responses'].get(table.name, []))
+                request = response.get('UnprocessedKeys')
+        return items
+
+    def is_known(self, digest):
+        res = self.history.get_item(Key={'UrlHash': digest.hex()})
+        return 'Item' in res
+
+    def known(self, digests):
+        keys = [{'UrlHash': d.hex()} for d in set(digests)]
+        items = self.batch_get(self.history, keys,
+                               ProjectionExpression='UrlHash')
+        return set(bytes.fromhex(item['UrlHash']) for item in items)
+
+    def add_known(self, digest):
+        self.history.put_item(Item={'UrlHash': digest.hex()})
+
+
+class SQLiteStore(SharedStore):
+    #
+    # SharedStore on a local SQLite file, for running several workers on
+    # one machine and for testing.
+    #
+
+    def __init__(self, path=SHARED_STORE_PATH, run_id=RUN_ID):
+        self.run_id = run_id
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS frontier ('
+                        'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                        'run TEXT, shard INTEGER, tag TEXT, url TEXT, '
+                        'depth INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS frontier_shard '
+                        'ON frontier (run, shard, id)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS claimed ('
+                        'run TEXT, digest BLOB, PRIMARY KEY (run, digest))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS known ('
+                        'digest BLOB PRIMARY KEY)')
+
+    def claim(self, digest):
+        cur = self.db.execute(
+            'INSERT OR IGNORE INTO claimed (run, digest) VALUES (?, ?)',
+            (self.run_id, digest))
+        return cur.rowcount == 1
+
+    def push(self, shard, tag, url, depth):
+        self.db.execute(
+            'INSERT INTO frontier (run, shard, tag, url, depth) '
+            'VALUES (?, ?, ?, ?, ?)', (self.run_id, shard, tag, url, depth))
+
+    def pop_all(self, shard):
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            rows = self.db.execute(
+                'SELECT id, tag, url, depth FROM frontier '
+                'WHERE run = ? AND shard = ? ORDER BY id',
+                (self.run_id, shard)).fetchall()
+            if rows:
+                self.db.execute(
+                    'DELETE FROM frontier WHERE run = ? AND shard = ? '
+                    'AND id <= ?', (self.run_id, shard, rows[-1][0]))
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+
+        return [(tag, url, depth) for (_, tag, url, depth) in rows]
+
+    def is_known(self, digest):
+        cur = self.db.execute('SELECT 1 FROM known WHERE digest = ?',
+                              (digest,))
+        return cur.fetchone() is not None
+
+    def known(self, digests):
+        digests = list(set(digests))
+        found = set()
+        for i in range(0, len(digests), 500):
+            chunk = digests[i:i + 500]
+            cur = self.db.execute(
+                'SELECT digest FROM known WHERE digest IN (%s)' %
+                ', '.join('?' * len(chunk)), chunk)
+            found.update(bytes(d) for (d, ) in cur)
+        return found
+
+    def add_known(self, digest):
+        self.db.execute('INSERT OR IGNORE INTO known (digest) VALUES (?)',
+                        (digest,))
+
+
+class SharedKnown:
+    #
+    # Drop-in for SeenStore that keeps visited urls in the shared store
+    #
+
+    def __init__(self, store):
+        self.store = store
+
+    def __contains__(self, digest):
+        return self.store.is_known(digest)
+
+    def known(self, digests):
+        return self.store.known(digests)
+
+    def add(self, digest):
+        self.store.add_known(digest)
+
+    def save(self):
+        pass
+
+
+class ShardedFrontier(Frontier):
+    #
+    # Frontier of one worker. Urls owned by other workers are forwarded
+    # through the shared store after being claimed; urls forwarded to this
+    # worker are pulled in before every pop.
+    #
+
+    def __init__(self,
+                 store,
+                 start_urls,
+                 worker_id=WORKER_ID,
+                 workers=WORKERS,
+                 idle_timeout=IDLE_TIMEOUT,
+                 **kwargs):
+        super().__init__(start_urls, **kwargs)
+        self.store = store
+        self.worker_id = worker_id
+        self.workers = workers
+        self.idle_timeout = idle_timeout
+        self.last_active = time.monotonic()
+        self.shard_stats = Counter()
+
+    def push(self, tag, url, depth):
+        if not self.store.claim(canonical_url(url)[1]):
+            self.shard_stats['claimed_elsewhere'] += 1
+            return
+
+        shard = shard_of(url, self.workers)
+        if shard == self.worker_id:
+            super().push(tag, url, depth)
+        else:
+            self.store.push(shard, tag, url, depth)
+            self.shard_stats['forwarded'] += 1
+
+    def receive(self):
+        try:
+            items = self.store.pop_all(self.worker_id)
+        except Exception as e:
+            # Polled again before the next pop
+            print('Could not read the shared queue:', e)
+            return
+        for (tag, url, depth) in items:
+            super().push(tag, url, depth)
+        if items:
+            self.shard_stats['received'] += len(items)
+            self.last_active = time.monotonic()
+
+    def pop(self):
+        if not self.exhausted():
+            self.receive()
+
+        item = super().pop()
+        if item is not None:
+            self.last_active = time.monotonic()
+        return item
+
+    def delay(self):
+        wait = super().delay()
+        if wait is not None or self.exhausted():
+            return wait
+
+        # Nothing queued locally, but other workers may still forward urls
+        if time.monotonic() - self.last_active >= self.idle_timeout:
+            return None
+        return POLL_INTERVAL
+
+    def report(self):
+        super().report()
+        print(f'worker={self.worker_id}/{self.workers} '
+              f'forwarded={self.shard_stats["forwarded"]} '
+              f'received={self.shard_stats["received"]} '
+              f'claimed_elsewhere={self.shard_stats["claimed_elsewhere"]}')
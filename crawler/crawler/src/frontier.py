@@ -0,0 +1,124 @@
+import heapq
+import itertools
+import os
+import time
+
+from collections import Counter
+
+from utils import parse_url
+
+# Stop after visiting this many pages, or after this many seconds (0 means
+# no time limit)
+MAX_PAGES = int(os.environ.get('CRAWL_MAX_PAGES', '500'))
+TIME_BUDGET = float(os.environ.get('CRAWL_TIME_BUDGET', '0'))
+# Minimum number of seconds between two requests to the same host
+POLITENESS_DELAY = float(os.environ.get('CRAWL_POLITENESS_DELAY', '0'))
+
+
+class Frontier:
+    #
+    # Crawl frontier that spends a fixed page/time budget fairly across the
+    # crawl input tags. Each tag gets a quota proportional to its number of
+    # start urls; tags that reached their quota are only served once every
+    # other tag is drained. Within a tag, shallower urls go first and urls
+    # of the same depth keep their discovery order, so the stories listed
+    # first on a topic page are fetched first. Hosts are not hit more than
+    # once every POLITENESS_DELAY seconds, and with a host_limit no more
+    # than that many urls of a host are out between pop() and done().
+    #
+
+    def __init__(self,
+                 start_urls,
+                 max_pages=MAX_PAGES,
+                 time_budget=TIME_BUDGET,
+                 politeness_delay=POLITENESS_DELAY,
+                 host_limit=None):
+        self.max_pages = max_pages
+        self.deadline = time.monotonic() + time_budget if time_budget else None
+        self.politeness_delay = politeness_delay
+        self.host_limit = host_limit
+
+        shares = Counter(tag for tag, _ in start_urls)
+        total = sum(shares.values()) or 1
+        self.quotas = {
+            tag: max(1, max_pages * n // total) for tag, n in shares.items()
+        }
+
+        self.queues = {}
+        self.visits = Counter()
+        self.host_ready = {}
+        self.host_active = Counter()
+        self.seq = itertools.count()
+        self.count = 0
+
+    def __len__(self):
+        return sum(len(q) for q in self.queues.values())
+
+    def push(self, tag, url, depth):
+        queue = self.queues.setdefault(tag, [])
+        heapq.heappush(queue, (depth, next(self.seq), url))
+
+    def exhausted(self):
+        if self.count >= self.max_pages:
+            return True
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def rank(self, tag):
+        (depth, seq, _) = self.queues[tag][0]
+        quota = self.quotas.get(tag, 1)
+        visits = self.visits[tag]
+        return (visits >= quota, depth, visits / quota, seq)
+
+    def host_busy(self, host):
+        return (self.host_limit is not None
+                and self.host_active[host] >= self.host_limit)
+
+    def pop(self):
+        if self.exhausted():
+            return None
+
+        now = time.monotonic()
+        tags = [t for t, q in self.queues.items() if q]
+        for tag in sorted(tags, key=self.rank):
+            (depth, _, url) = self.queues[tag][0]
+            host = parse_url(url).netloc.lower()
+            if self.host_ready.get(host, 0) > now or self.host_busy(host):
+                continue
+
+            heapq.heappop(self.queues[tag])
+            self.host_ready[host] = now + self.politeness_delay
+            self.host_active[host] += 1
+            self.visits[tag] += 1
+            self.count += 1
+            return tag, url, depth
+
+        return None
+
+    def done(self, url):
+        # The url returned by pop() was fetched; frees its host slot
+        host = parse_url(url).netloc.lower()
+        if self.host_active[host] > 0:
+            self.host_active[host] -= 1
+
+    def delay(self):
+        # Seconds until pop() can return a url, or None if nothing is queued
+        # or every queued host is waiting for done()
+        if self.exhausted():
+            return None
+
+        now = time.monotonic()
+        waits = []
+        for q in self.queues.values():
+            if q:
+                host = parse_url(q[0][2]).netloc.lower()
+                if not self.host_busy(host):
+                    waits.append(max(0, self.host_ready.get(host, 0) - now))
+
+        return min(waits) if waits else None
+
+    def report(self):
+        print('\nFrontier:')
+        print(f'visited={self.count} queued={len(self)}')
+        for tag in sorted(set(self.quotas) | set(self.visits)):
+            print(f'{tag}: visited={self.visits[tag]} '
+                  f'quota={self.quotas.get(tag, 1)}')
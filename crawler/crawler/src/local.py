@@ -1,12 +1,34 @@
+import asyncio
+import os
 import sys
+import time
 
-from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+from playwright.async_api import async_playwright
 from playwright.sync_api import sync_playwright
 
+import async_core
+from common import CrawlState
 from core import extract_page_content_and_urls
-from utils import create_crawl_input, get_hash, normalize_url
-from s3 import save_content
+from distributed import (WORKERS, SharedKnown, ShardedFrontier,
+                         get_shared_store)
+from frontier import Frontier
+from pool import AsyncContextPool, ContextPool
+from render import RenderProfile
+from seen import SeenStore
+from utils import canonical_url, create_crawl_input
+from s3 import (download_state, flush_uploads, save_content, saved_uploads,
+                upload_state)
+
+# Number of pages rendered at the same time by crawl_async, and the
+# maximum number of those that may target the same host. The host is the
+# one of the queued url; Google News article urls all share
+# news.google.com and only redirect to their publisher when rendered, so
+# by default the limit does not hold them back.
+CONCURRENCY = int(os.environ.get('CRAWL_CONCURRENCY', '8'))
+DOMAIN_CONCURRENCY = int(
+    os.environ.get('CRAWL_DOMAIN_CONCURRENCY', str(CONCURRENCY)))
 
 
 def crawl(browser, crawl_input):
@@ -16,67 +38,269 @@ def crawl(browser, crawl_input):
     #         Ignore content from start urls; we only care about links
     #
 
-    start_urls = set(crawl_input.start_urls)
-    url_queue = deque(crawl_input.start_urls)
-    seen_urls = set()
-
-    count = 0
+    state = init_state(crawl_input)
+    profile = load_profile()
+    pool = ContextPool(browser)
 
-    while url_queue:
-        if count >= 500:
-            break
-        count += 1
-
-        (tag, url) = url_queue.popleft()
-        url_hash = get_hash(url)
-        if url_hash in seen_urls:
+    while True:
+        item = state.frontier.pop()
+        if item is None:
+            wait = state.frontier.delay()
+            if wait is None:
+                break
+            # Every queued host is still within its politeness delay
+            time.sleep(wait)
             continue
-        seen_urls.add(url_hash)
+        (tag, url, depth) = item
 
         print('\nVisiting', url)
 
-        out = extract_page_content_and_urls(browser, url, crawl_input)
-        if out.err:
-            print('Could not visit url', url)
-            print('Error:', out.err.err)
-            print(out.err.trace)
+        out = extract_page_content_and_urls(pool, url, crawl_input, profile)
+        to_save = handle_page(out, tag, url, depth, state)
+        if to_save:
+            queued = save_content(*to_save)
+            page_saved(state, to_save, queued)
+
+    finish(state)
+    pool.close()
+    pool.report()
+    save_profile(profile)
+
+
+async def crawl_async(browser,
+                      crawl_input,
+                      concurrency=CONCURRENCY,
+                      domain_concurrency=DOMAIN_CONCURRENCY):
+    loop = asyncio.get_running_loop()
+
+    # The frontier and url stores are only used from this thread; in a
+    # distributed crawl their calls go to DynamoDB or SQLite and would
+    # otherwise stall every page being rendered
+    state_thread = ThreadPoolExecutor(max_workers=1)
+
+    def on_state(func, *args):
+        return loop.run_in_executor(state_thread, func, *args)
+
+    # Hosts at their limit are skipped by the frontier, so a worker never
+    # holds a url while it waits for a slot
+    state = await on_state(init_state, crawl_input, domain_concurrency)
+    profile = load_profile()
+    pool = AsyncContextPool(browser)
+
+    queue_changed = asyncio.Condition()
+
+    in_flight = 0
+
+    async def next_url():
+        nonlocal in_flight
+
+        async with queue_changed:
+            while True:
+                item = await on_state(state.frontier.pop)
+                if item is not None:
+                    in_flight += 1
+                    return item
+
+                wait = await on_state(state.frontier.delay)
+                if wait is None and not in_flight:
+                    queue_changed.notify_all()
+                    return None
+
+                # Frontier may still be refilled by pages that are in
+                # flight, a host may leave its politeness delay or get a
+                # slot back
+                try:
+                    await asyncio.wait_for(queue_changed.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def worker():
+        nonlocal in_flight
+
+        while True:
+            item = await next_url()
+            if item is None:
+                return
+            (tag, url, depth) = item
+
+            try:
+                print('\nVisiting', url)
+                out = await async_core.extract_page_content_and_urls(
+                    pool, url, crawl_input, profile)
+
+                to_save = await on_state(handle_page, out, tag, url, depth,
+                                         state)
+                if to_save:
+                    # Keep the event loop rendering if the upload queue is full
+                    queued = await loop.run_in_executor(
+                        None, save_content, *to_save)
+                    await on_state(page_saved, state, to_save, queued)
+            finally:
+                async with queue_changed:
+                    await on_state(state.frontier.done, url)
+                    in_flight -= 1
+                    queue_changed.notify_all()
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    await on_state(finish, state)
+    state_thread.shutdown()
+    await pool.close()
+    pool.report()
+    save_profile(profile)
+
+
+def load_profile():
+    profile = RenderProfile()
+    download_state(profile.path)
+    return profile.load()
+
+
+def save_profile(profile):
+    profile.save()
+    upload_state(profile.path)
+    profile.report()
+
+
+def init_state(crawl_input, host_limit=None):
+    if WORKERS > 1:
+        # Distributed crawl: frontier and dedup coordinated across workers
+        store = get_shared_store()
+        frontier = ShardedFrontier(store,
+                                   crawl_input.start_urls,
+                                   host_limit=host_limit)
+        known_urls = SharedKnown(store)
+    else:
+        frontier = Frontier(crawl_input.start_urls, host_limit=host_limit)
+        known_urls = SeenStore()
+        download_state(known_urls.path)
+        known_urls.load()
+
+    state = CrawlState(
+        frontier=frontier,
+        seen_urls=set(),
+        known_urls=known_urls,
+        start_urls=set(
+            canonical_url(url)[0] for _, url in crawl_input.start_urls),
+    )
+
+    for (tag, url) in crawl_input.start_urls:
+        enqueue(state, tag, [url], 0)
+
+    return state
+
+
+def finish(state):
+    mark_known(state, flush_uploads())
+    state.known_urls.save()
+    if isinstance(state.known_urls, SeenStore):
+        upload_state(state.known_urls.path)
+    state.frontier.report()
+
+
+def enqueue(state, tag, urls, depth):
+    new = {}
+    for url in urls:
+        (url, url_digest) = canonical_url(url)
+        if url_digest in state.seen_urls:
             continue
+        state.seen_urls.add(url_digest)
+        new[url_digest] = url
+
+    # Start urls are revisited on every run to discover fresh articles;
+    # the others are looked up together, in one request to a shared store
+    known = state.known_urls.known(
+        d for d, url in new.items() if url not in state.start_urls)
+    for url_digest, url in new.items():
+        if url_digest not in known:
+            state.frontier.push(tag, url, depth)
+
+
+def handle_page(out, tag, url, depth, state):
+    try:
+        return handle_output(out, tag, url, depth, state)
+    except Exception as e:
+        # A shared store that fails, e.g. once throttled requests run out
+        # of retries, loses the links of this page rather than the crawl
+        print('Could not handle', url, e)
+        return None
+
+
+def handle_output(out, tag, url, depth, state):
+    if out.err:
+        print('Could not visit url', url)
+        print('Error:', out.err.err)
+        print(out.err.trace)
+        return None
 
-        print(out.status)
-        #
-        # TODO:
-        #       Handle where status != 200
-        #
+    print(out.status)
+    #
+    # TODO:
+    #       Handle where status != 200
+    #
+
+    (nurl, real_digest) = canonical_url(out.real_url)
+    state.seen_urls.add(real_digest)
 
-        if out.real_url != url:
-            seen_urls.add(get_hash(normalize_url(out.real_url)))
+    enqueue(state, tag, out.new_urls, depth + 1)
 
-        for u in out.new_urls:
-            url_queue.append((tag, normalize_url(u)))
+    print('Title:', out.content.title)
+    print('Tag:', tag)
+    print('Found', len(out.new_urls), 'new urls')
+
+    #
+    # TODO:
+    #       Some checks:
+    #           check if ip is blocked
+    #           content type
+    #           any further error handling
 
-        print('Title:', out.content.title)
-        print('Tag:', tag)
-        print('Found', len(out.new_urls), 'new urls')
+    # Handle content only if not from initial start urls...
+    if url in state.start_urls:
+        return None
 
-        # Handle content only if not from initial start urls...
-        if url not in start_urls:
-            nurl = normalize_url(out.real_url)
-            save_content(get_hash(nurl), nurl, out.content)
+    # The digests to record as known once the page is saved
+    return real_digest.hex(), nurl, out.content, (canonical_url(url)[1],
+                                                  real_digest)
 
-        #
-        # TODO:
-        #       Some checks:
-        #           check if ip is blocked
-        #           content type
-        #           any further error handling
+
+def page_saved(state, to_save, queued):
+    # Only pages that reached the bucket are skipped by later runs: their
+    # digests are recorded once the upload succeeded, or right away for
+    # pages that are not uploaded at all
+    done = saved_uploads()
+    if not queued:
+        done.append(to_save[3])
+    mark_known(state, done)
+
+
+def mark_known(state, done):
+    for digests in done:
+        try:
+            for digest in digests:
+                state.known_urls.add(digest)
+        except Exception as e:
+            print('Could not record visited url', e)
+
+
+async def run_async(crawl_input):
+    async with async_playwright() as pw:
+        browser = await pw.chromium.launch(headless=True)
+        await crawl_async(browser, crawl_input)
+        await browser.close()
 
 
 def main(argv):
     if not argv:
         print('Error: Crawl Input file must be specified.')
+        return
 
     crawl_input = create_crawl_input(argv[0])
 
+    if CONCURRENCY > 1:
+        asyncio.run(run_async(crawl_input))
+        return
+
     with sync_playwright() as pw:
         browser = pw.chromium.launch(headless=True)
         crawl(browser, crawl_input)
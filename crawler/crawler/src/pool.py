@@ -0,0 +1,151 @@
+import os
+
+from collections import Counter
+
+from core import VIEWPORT, block_aggressively
+import async_core
+
+# Recycle a context after it rendered this many pages
+MAX_PAGES_PER_CONTEXT = int(os.environ.get('CONTEXT_MAX_PAGES', '50'))
+# Recycle a context once its page's JS heap grows past this size
+MAX_HEAP_MB = int(os.environ.get('CONTEXT_MAX_HEAP_MB', '256'))
+
+HEAP_SCRIPT = ('() => performance.memory ? '
+               'performance.memory.usedJSHeapSize : 0')
+
+
+class PooledPage:
+
+    def __init__(self, context, page):
+        self.context = context
+        self.page = page
+        self.uses = 0
+
+
+class BasePool:
+    #
+    # Keeps browser contexts (and their single page with the resource
+    # blocking route already registered) alive between urls, recycling
+    # them after MAX_PAGES_PER_CONTEXT pages, after an error or when the
+    # JS heap grows past MAX_HEAP_MB.
+    #
+
+    def __init__(self,
+                 browser,
+                 max_pages=MAX_PAGES_PER_CONTEXT,
+                 max_heap_mb=MAX_HEAP_MB):
+        self.browser = browser
+        self.max_pages = max_pages
+        self.max_heap = max_heap_mb * 1024 * 1024
+        self.idle = []
+        self.stats = Counter()
+
+    def take_idle(self):
+        self.stats['acquired'] += 1
+        if self.idle:
+            self.stats['reused'] += 1
+            return self.idle.pop()
+        self.stats['created'] += 1
+        return None
+
+    def recycle_reason(self, slot, failed, heap):
+        if failed:
+            return 'error'
+        if slot.uses >= self.max_pages:
+            return 'max_pages'
+        if heap > self.max_heap:
+            return 'memory'
+        return None
+
+    def report(self):
+        acquired = self.stats['acquired']
+        reuse_rate = self.stats['reused'] / acquired if acquired else 0
+
+        print('\nContext pool:')
+        print(f'acquired={acquired} created={self.stats["created"]} '
+              f'reuse_rate={reuse_rate:.1%}')
+        for reason in ('error', 'max_pages', 'memory'):
+            print(f'recycled ({reason}): {self.stats["recycled_" + reason]}')
+
+
+class ContextPool(BasePool):
+
+    def new_slot(self):
+        context = self.browser.new_context(viewport=VIEWPORT)
+        page = context.new_page()
+
+        # TODO:
+        #       add user-agent to the context
+        #
+
+        page.route('**/*', block_aggressively)
+        return PooledPage(context, page)
+
+    def acquire(self):
+        slot = self.take_idle()
+        if slot is None:
+            slot = self.new_slot()
+        slot.uses += 1
+        return slot
+
+    def release(self, slot, failed=False):
+        heap = 0
+        if not failed:
+            try:
+                heap = slot.page.evaluate(HEAP_SCRIPT)
+            except Exception:
+                failed = True
+
+        reason = self.recycle_reason(slot, failed, heap)
+        if reason is None:
+            self.idle.append(slot)
+            return
+
+        self.stats['recycled_' + reason] += 1
+        try:
+            slot.context.close()
+        except Exception as e:
+            print('Could not close context:', e)
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().context.close()
+
+
+class AsyncContextPool(BasePool):
+
+    async def new_slot(self):
+        context = await self.browser.new_context(viewport=VIEWPORT)
+        page = await context.new_page()
+        await page.route('**/*', async_core.block_aggressively)
+        return PooledPage(context, page)
+
+    async def acquire(self):
+        slot = self.take_idle()
+        if slot is None:
+            slot = await self.new_slot()
+        slot.uses += 1
+        return slot
+
+    async def release(self, slot, failed=False):
+        heap = 0
+        if not failed:
+            try:
+                heap = await slot.page.evaluate(HEAP_SCRIPT)
+            except Exception:
+                failed = True
+
+        reason = self.recycle_reason(slot, failed, heap)
+        if reason is None:
+            self.idle.append(slot)
+            return
+
+        self.stats['recycled_' + reason] += 1
+        try:
+            await slot.context.close()
+        except Exception as e:
+            print('Could not close context:', e)
+
+    async def close(self):
+        while self.idle:
+            await self.idle.pop().context.close()
@@ -0,0 +1,132 @@
+import json
+import os
+import time
+
+from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+
+from utils import parse_url
+
+# Upper bound of the render wait; this is what every page used to pay
+MAX_RENDER_WAIT = 2000
+# networkidle needs 500ms without requests, so never wait less than that
+MIN_RENDER_WAIT = 500
+# Headroom over the learned time-to-idle of a domain
+WAIT_MARGIN = 1.5
+# Weight of the newest observation in the moving average
+ALPHA = 0.3
+
+PROFILE_PATH = os.environ.get('RENDER_PROFILE_PATH', './render_profile.json')
+
+
+class RenderProfile:
+    #
+    # Per-domain render wait learned from how long pages of that domain
+    # take to reach network idle. Persisted between runs so that known
+    # domains start with a tight budget.
+    #
+
+    def __init__(self, path=PROFILE_PATH):
+        self.path = path
+        self.domains = {}
+        self.stats = {}
+
+    def load(self):
+        if self.path and os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.domains = json.load(f)
+        return self
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(self.domains, f, indent=2, sort_keys=True)
+        except OSError as e:
+            # e.g. read-only filesystem when running as a Lambda
+            print('Could not save render profile:', e)
+
+    def budget(self, domain):
+        entry = self.domains.get(domain)
+        if entry is None:
+            return MAX_RENDER_WAIT
+
+        wait = entry['idle_ms'] * WAIT_MARGIN
+        return int(min(MAX_RENDER_WAIT, max(MIN_RENDER_WAIT, wait)))
+
+    def record(self, domain, waited_ms, idle):
+        # A timeout means the budget was too small, learn towards the cap
+        observed = waited_ms if idle else MAX_RENDER_WAIT
+
+        entry = self.domains.get(domain)
+        if entry is None:
+            entry = {'idle_ms': observed, 'samples': 0}
+            self.domains[domain] = entry
+        else:
+            entry['idle_ms'] = (ALPHA * observed +
+                                (1 - ALPHA) * entry['idle_ms'])
+        entry['samples'] += 1
+
+        stats = self.stats.setdefault(domain, {
+            'pages': 0,
+            'waited_ms': 0,
+            'timeouts': 0
+        })
+        stats['pages'] += 1
+        stats['waited_ms'] += waited_ms
+        if not idle:
+            stats['timeouts'] += 1
+
+    def report(self):
+        print('\nRender wait per domain:')
+
+        total_pages = 0
+        total_saved = 0
+        for domain, s in sorted(self.stats.items()):
+            saved = s['pages'] * MAX_RENDER_WAIT - s['waited_ms']
+            total_pages += s['pages']
+            total_saved += saved
+            print(f'{domain}: pages={s["pages"]} '
+                  f'avg_wait={s["waited_ms"] / s["pages"]:.0f}ms '
+                  f'saved={saved / 1000:.1f}s timeouts={s["timeouts"]}')
+
+        if total_pages:
+            print(f'Total saved: {total_saved / 1000:.1f}s '
+                  f'({total_saved / total_pages:.0f}ms per page)')
+
+
+def render_domain(page):
+    return parse_url(page.url).netloc.lower()
+
+
+def wait_for_render(page, profile):
+    if profile is None:
+        page.wait_for_timeout(MAX_RENDER_WAIT)
+        return
+
+    domain = render_domain(page)
+    start = time.monotonic()
+    try:
+        page.wait_for_load_state('networkidle', timeout=profile.budget(domain))
+        idle = True
+    except PlaywrightTimeoutError:
+        idle = False
+
+    profile.record(domain, (time.monotonic() - start) * 1000, idle)
+
+
+async def wait_for_render_async(page, profile):
+    if profile is None:
+        await page.wait_for_timeout(MAX_RENDER_WAIT)
+        return
+
+    domain = render_domain(page)
+    start = time.monotonic()
+    try:
+        await page.wait_for_load_state('networkidle',
+                                       timeout=profile.budget(domain))
+        idle = True
+    except PlaywrightTimeoutError:
+        idle = False
+
+    profile.record(domain, (time.monotonic() - start) * 1000, idle)
@@ -1,9 +1,28 @@
+import gzip
+import os
+import queue
+import random
+import threading
+import time
+
 import boto3
 
-from utils import url_is_from_any_domain
+from utils import UrlMatcher
 
 BUCKET = 'daily-digest-v1-crawled-content'
 
+# State files kept between crawls (render profile, seen urls), which would
+# otherwise be lost with the filesystem of the ECS task; empty to disable
+STATE_BUCKET = os.environ.get('CRAWL_STATE_BUCKET', f'{BUCKET}-state')
+STATE_PREFIX = 'crawler/'
+
+# Uploads run on background threads so rendering never waits on S3; the
+# crawl blocks only when UPLOAD_QUEUE_SIZE pages are waiting
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', '4'))
+UPLOAD_QUEUE_SIZE = int(os.environ.get('UPLOAD_QUEUE_SIZE', '64'))
+MAX_ATTEMPTS = 5
+BACKOFF = 0.5
+
 WHITELIST = [
     'cnn.com',
     'usatoday.com',
@@ -32,18 +51,171 @@ WHITELIST = [
     'politifact.com',
 ]
 
+WHITELIST_MATCHER = UrlMatcher(WHITELIST, any_path=True)
+
+_client = None
+_client_lock = threading.Lock()
+
+_uploader = None
+_uploader_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+
+    # boto3 clients are thread-safe; create one and share it
+    with _client_lock:
+        if _client is None:
+            _client = boto3.client('s3')
+        return _client
+
+
+def put_content(key, url, content):
+    raw = content.html_content.encode('utf-8')
+    body = gzip.compress(raw)
+
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            response = get_client().put_object(Body=body,
+                                               Bucket=BUCKET,
+                                               Key=key,
+                                               ContentEncoding='gzip',
+                                               ContentType='text/html',
+                                               Metadata={'url': url})
+            print('Saved', url, response['ResponseMetadata']['HTTPStatusCode'])
+            return len(raw), len(body)
+        except Exception as e:
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            wait = BACKOFF * 2**attempt * (1 + random.random())
+            print(f'Upload of {url} failed ({e}); retrying in {wait:.1f}s')
+            time.sleep(wait)
+
+
+class Uploader:
+
+    def __init__(self, workers=UPLOAD_WORKERS, queue_size=UPLOAD_QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.stats = {'uploaded': 0, 'failed': 0, 'raw': 0, 'sent': 0}
+        # Tokens of the pages uploaded so far, collected by saved()
+        self.done = queue.SimpleQueue()
+        self.threads = [
+            threading.Thread(target=self.run, daemon=True)
+            for _ in range(workers)
+        ]
+        for t in self.threads:
+            t.start()
+
+    def submit(self, key, url, content, token=None):
+        self.queue.put((key, url, content, token))
+
+    def saved(self):
+        tokens = []
+        while not self.done.empty():
+            tokens.append(self.done.get())
+        return tokens
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            (key, url, content, token) = item
+            try:
+                (raw, sent) = put_content(key, url, content)
+            except Exception as e:
+                print('Could not save', url, e)
+                with self.lock:
+                    self.stats['failed'] += 1
+            else:
+                with self.lock:
+                    self.stats['uploaded'] += 1
+                    self.stats['raw'] += raw
+                    self.stats['sent'] += sent
+                if token is not None:
+                    self.done.put(token)
 
-def save_content(key, url, content):
-    print(url)
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
 
-    if not url_is_from_any_domain(url, WHITELIST):
+    def report(self):
+        s = self.stats
+        ratio = s['sent'] / s['raw'] if s['raw'] else 0
+        print('\nUploads:')
+        print(f'uploaded={s["uploaded"]} failed={s["failed"]} '
+              f'raw={s["raw"] / 1e6:.1f}MB sent={s["sent"] / 1e6:.1f}MB '
+              f'({ratio:.0%})')
+
+
+def save_content(key, url, content, token=None):
+    # Returns whether the page is uploaded; its token is handed back by
+    # saved_uploads() once the upload succeeded
+    global _uploader
+
+    if not WHITELIST_MATCHER.matches(url):
+        return False
+
+    print('SAVING content...', url)
+
+    with _uploader_lock:
+        if _uploader is None:
+            _uploader = Uploader()
+        uploader = _uploader
+
+    uploader.submit(key, url, content, token)
+    return True
+
+
+def saved_uploads():
+    with _uploader_lock:
+        uploader = _uploader
+    return uploader.saved() if uploader is not None else []
+
+
+def flush_uploads():
+    global _uploader
+
+    # Wait for queued uploads; called once a crawl is done. Returns the
+    # tokens of the uploads that finished since the last saved_uploads()
+    with _uploader_lock:
+        uploader = _uploader
+        _uploader = None
+
+    if uploader is None:
+        return []
+
+    uploader.close()
+    uploader.report()
+    return uploader.saved()
+
+
+def download_state(path):
+    if not STATE_BUCKET or not path:
         return
 
-    print('SAVING content...')
+    key = STATE_PREFIX + os.path.basename(path)
+    try:
+        get_client().download_file(STATE_BUCKET, key, path)
+    except Exception as e:
+        # Missing on the first run; the crawl then starts from scratch
+        print(f'Could not load s3://{STATE_BUCKET}/{key}:', e)
+    else:
+        print(f'Loaded s3://{STATE_BUCKET}/{key}')
+
+
+def upload_state(path):
+    if not STATE_BUCKET or not path or not os.path.exists(path):
+        return
 
-    s3client = boto3.client('s3')
-    response = s3client.put_object(Body=content.html_content,
-                                   Bucket=BUCKET,
-                                   Key=key,
-                                   Metadata={'url': url})
-    print(response)
+    key = STATE_PREFIX + os.path.basename(path)
+    try:
+        get_client().upload_file(path, STATE_BUCKET, key)
+    except Exception as e:
+        print(f'Could not save s3://{STATE_BUCKET}/{key}:', e)
+    else:
+        print(f'Saved s3://{STATE_BUCKET}/{key}')
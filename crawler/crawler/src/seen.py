@@ -0,0 +1,119 @@
+import mmap
+import os
+
+DIGEST_SIZE = 16
+
+STORE_PATH = os.environ.get('SEEN_STORE_PATH', './seen_urls.bin')
+
+
+class SeenStore:
+    #
+    # Persistent set of raw 16-byte url digests. Known digests live in a
+    # sorted file that is memory-mapped and binary searched; digests added
+    # during a run are kept in memory and appended to a journal so they
+    # survive a crash. save() merges the journal into the sorted file.
+    #
+
+    def __init__(self, path=STORE_PATH):
+        self.path = path
+        self.journal_path = f'{path}.log'
+        self.base = None
+        self.base_file = None
+        self.count = 0
+        self.added = set()
+        self.journal = None
+
+    def load(self):
+        if not self.path:
+            return self
+
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            self.base_file = open(self.path, 'rb')
+            self.base = mmap.mmap(self.base_file.fileno(),
+                                  0,
+                                  access=mmap.ACCESS_READ)
+            self.count = len(self.base) // DIGEST_SIZE
+
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb') as f:
+                data = f.read()
+            for i in range(0, len(data) - DIGEST_SIZE + 1, DIGEST_SIZE):
+                self.added.add(data[i:i + DIGEST_SIZE])
+
+        try:
+            self.journal = open(self.journal_path, 'ab')
+        except OSError as e:
+            print('Seen urls will not be persisted:', e)
+
+        print('Loaded', self.count + len(self.added), 'seen urls')
+        return self
+
+    def __contains__(self, digest):
+        return digest in self.added or self.in_base(digest)
+
+    def known(self, digests):
+        return set(d for d in digests if d in self)
+
+    def __len__(self):
+        return self.count + len(self.added)
+
+    def in_base(self, digest):
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = mid * DIGEST_SIZE
+            rec = self.base[start:start + DIGEST_SIZE]
+            if rec < digest:
+                lo = mid + 1
+            elif rec > digest:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def add(self, digest):
+        if digest in self:
+            return
+        self.added.add(digest)
+        if self.journal is not None:
+            self.journal.write(digest)
+
+    def save(self):
+        if self.journal is None:
+            return
+
+        self.journal.flush()
+        if not self.added:
+            return
+
+        tmp_path = f'{self.path}.tmp'
+        new = sorted(self.added)
+        with open(tmp_path, 'wb') as out:
+            # Merge the sorted base with the sorted new digests
+            j = 0
+            for i in range(self.count):
+                rec = self.base[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]
+                while j < len(new) and new[j] < rec:
+                    out.write(new[j])
+                    j += 1
+                out.write(rec)
+            for d in new[j:]:
+                out.write(d)
+
+        self.close()
+        os.replace(tmp_path, self.path)
+        os.remove(self.journal_path)
+        self.load()
+
+    def close(self):
+        if self.base is not None:
+            self.base.close()
+            self.base_file.close()
+            self.base = None
+            self.base_file = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        self.count = 0
+        self.added = set()
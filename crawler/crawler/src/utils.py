@@ -1,5 +1,6 @@
 import hashlib
 
+from functools import lru_cache
 from w3lib.url import canonicalize_url, url_query_cleaner
 from urllib.parse import ParseResult, urlparse
 
@@ -10,11 +11,26 @@ def get_hash(s):
     return hashlib.md5(s.encode('utf-8')).hexdigest()
 
 
+def get_digest(s):
+    return hashlib.md5(s.encode('utf-8')).digest()
+
+
 def normalize_url(url):
     safe_url = canonicalize_url(url)
     return url_query_cleaner(safe_url)
 
 
+# The same links show up on many pages of a crawl; remember the most
+# recent ones instead of normalizing and hashing them again
+URL_CACHE_SIZE = 1 << 16
+
+
+@lru_cache(maxsize=URL_CACHE_SIZE)
+def canonical_url(url):
+    nurl = normalize_url(url)
+    return nurl, get_digest(nurl)
+
+
 def url_is_from_any_domain(url, domains):
     host = parse_url(url).netloc.lower()
     if not host:
@@ -28,6 +44,46 @@ def url_has_any_path(url, paths):
     return any(path.startswith(p) for p in paths)
 
 
+class UrlMatcher:
+    #
+    # Domain/path filter compiled once from a domain and path list.
+    # Domains go in a hashed set that is probed with every label suffix of
+    # the host, so the cost depends on the host depth rather than on the
+    # number of domains; paths are checked with a single str.startswith
+    # over the prefix tuple. As with url_has_any_path, an empty path list
+    # matches nothing unless any_path is set.
+    #
+
+    def __init__(self, domains, paths=(), any_path=False):
+        self.domains = frozenset(d.lower() for d in domains)
+        self.paths = tuple(p.lower() for p in paths)
+        self.any_path = any_path
+
+    def match_host(self, host):
+        host = host.lower()
+        while host:
+            if host in self.domains:
+                return True
+            dot = host.find('.')
+            if dot < 0:
+                return False
+            host = host[dot + 1:]
+        return False
+
+    def match_path(self, path):
+        return self.any_path or path.lower().startswith(self.paths)
+
+    def matches(self, url):
+        parsed = parse_url(url)
+        return (self.match_host(parsed.netloc) and
+                self.match_path(parsed.path))
+
+
+@lru_cache(maxsize=16)
+def compile_matcher(domains, paths=()):
+    return UrlMatcher(domains, paths)
+
+
 def url_has_any_extension(url, extensions):
     path = parse_url(url).path.lower()
     return any(path.endswith(ext) for ext in extensions)
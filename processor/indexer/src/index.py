@@ -1,13 +1,11 @@
 import json
 import os
 import datetime
+import time
 
 import boto3
 from botocore.exceptions import ClientError
 
-from opensearchpy import OpenSearch, RequestsHttpConnection
-from requests_aws4auth import AWS4Auth
-
 REGION = os.environ['REGION']
 INF_METADATA_TABLE = os.environ['INF_METADATA_TABLE']
 METADATA_TABLE = os.environ['METADATA_TABLE']
@@ -17,61 +15,226 @@ SUMMARY_BUCKET = os.environ['SUMMARY_BUCKET']
 HOST = os.environ['OPENSEARCH_ENDPOINT']
 INDEX = os.environ['OPENSEARCH_INDEX']
 
+# Newly indexed articles invalidate the recommendations api/recommend
+# cached for their tags, through versions kept in the history table;
+# nothing is invalidated when unset
+HISTORY_TABLE = os.environ.get('HISTORY_TABLE')
+VERSIONS_KEY = 'recommend#versions'
+TAG_PREFIX = 'tag:'
+ALL_ARTICLES = 'all'
+
+# Documents per _bulk request, and the longest time an update may wait in
+# the buffer before it is sent
+BULK_SIZE = int(os.environ.get('BULK_SIZE', '100'))
+BULK_INTERVAL = float(os.environ.get('BULK_INTERVAL', '5'))
+
+
+# Created on first use and reused by warm invocations of the container
+_dynamodb = None
+_s3 = None
+_opensearch = None
+
+
+def get_table(name):
+    global _dynamodb
+    if _dynamodb is None:
+        _dynamodb = boto3.resource('dynamodb')
+    return _dynamodb.Table(name)
+
+
+def get_s3():
+    global _s3
+    if _s3 is None:
+        _s3 = boto3.client('s3')
+    return _s3
+
+
+def get_opensearch():
+    global _opensearch
+    if _opensearch is None:
+        # Imported here to keep it out of the module import time
+        from opensearchpy import OpenSearch, RequestsHttpConnection
+
+        _opensearch = OpenSearch(hosts=[{
+            'host': HOST,
+            'port': 443
+        }],
+                                 http_auth=get_awsauth(REGION, 'es'),
+                                 use_ssl=True,
+                                 verify_certs=True,
+                                 connection_class=RequestsHttpConnection)
+    return _opensearch
+
 
 def lambda_handler(event, context):
     print("Received event: " + json.dumps(event))
 
-    object_key = event['Records'][0]['s3']['object']['key']
-    bucket = event['Records'][0]['s3']['bucket']['name']
+    indexer = BulkIndexer()
+    failures = []
+
+    for (message_id, record) in s3_records(event):
+        try:
+            handle_record(record, indexer, message_id)
+        except Exception as e:
+            print('Could not index', record['s3']['object']['key'], e)
+            failures.append(message_id)
+
+    indexer.flush()
+    failures.extend(indexer.failed)
+    update_versions(indexer.tags)
+
+    # Only SQS can retry individual records of a batch; a plain S3
+    # notification is retried as a whole by failing the invocation
+    failures = set(failures)
+    if None in failures:
+        raise RuntimeError(f'{len(failures)} records failed')
+    if failures:
+        return {
+            'batchItemFailures': [{
+                'itemIdentifier': m
+            } for m in sorted(failures)]
+        }
+
+    return {'statusCode': 200, 'body': json.dumps('Hello from Index Lambda!')}
+
+
+def s3_records(event):
+    # Yields (sqs message id, s3 record) for plain S3 notifications and for
+    # S3 notifications delivered through an SQS batch
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            body = json.loads(record['body'])
+            for r in body.get('Records', []):
+                yield record['messageId'], r
+        elif 's3' in record:
+            yield None, record
+
+
+def handle_record(record, indexer, message_id):
+    object_key = record['s3']['object']['key']
+    bucket = record['s3']['bucket']['name']
 
     data = get_data(object_key, bucket)
 
-    key = get_item({'OutputLocation': object_key},
-                   INF_METADATA_TABLE)['Item']['UrlHash']
-    metadata = get_item({'UrlHash': key}, METADATA_TABLE)['Item']
+    inf_metadata = get_item({'OutputLocation': object_key},
+                            INF_METADATA_TABLE)['Item']
 
-    metadata['timestamp'] = datetime.datetime.now().isoformat()
+    for key, output in split_outputs(inf_metadata, data):
+        if bucket == CLASSIFY_BUCKET:
+            metadata = update_metadata(key, 'tags', extract_tags(output))
+        else:
+            metadata = update_metadata(key, 'summary',
+                                       output[0]['summary_text'])
 
-    if bucket == CLASSIFY_BUCKET:
-        tags = extract_tags(data)
-        metadata['tags'] = tags
-        insert_item(metadata, METADATA_TABLE)
-        index_item(key, metadata)
-    else:
-        summary = data[0]['summary_text']
-        metadata['summary'] = summary
-        insert_item(metadata, METADATA_TABLE)
-        index_item(key, metadata)
+        # Classification and summary results arrive as separate events;
+        # the article is indexed once, by whichever event completes it
+        if 'tags' in metadata and 'summary' in metadata:
+            indexer.add(key, metadata, message_id)
 
-    return {'statusCode': 200, 'body': json.dumps('Hello from Index Lambda!')}
 
+def split_outputs(inf_metadata, data):
+    # Single-article payloads map the whole output to UrlHash
+    if 'UrlHashes' not in inf_metadata:
+        return [(inf_metadata['UrlHash'], data)]
 
-def get_awsauth(region, service):
-    cred = boto3.Session().get_credentials()
-    return AWS4Auth(cred.access_key,
-                    cred.secret_key,
-                    region,
-                    service,
-                    session_token=cred.token)
+    # Batched payloads produce one output per input, in input order
+    keys = inf_metadata['UrlHashes']
+    if len(keys) != len(data):
+        raise ValueError(f'{len(data)} outputs for {len(keys)} inputs')
+
+    return [(key, out if isinstance(out, list) else [out])
+            for key, out in zip(keys, data)]
 
 
-def index_item(key, data):
-    client = OpenSearch(hosts=[{
-        'host': HOST,
-        'port': 443
-    }],
-                        http_auth=get_awsauth(REGION, 'es'),
-                        use_ssl=True,
-                        verify_certs=True,
-                        connection_class=RequestsHttpConnection)
+def update_versions(tags):
+    if HISTORY_TABLE is None or not tags:
+        return
 
-    # # Delete the index
-    # print('Deleting index')
-    # print(client.indices.delete(index=INDEX))
+    names = {'#all': ALL_ARTICLES}
+    adds = ['#all :one']
+    for i, t in enumerate(sorted(tags)):
+        names['#t%d' % i] = TAG_PREFIX + t
+        adds.append('#t%d :one' % i)
 
-    body = {'doc': data, 'doc_as_upsert': True}
-    client.index(index=INDEX, id=key, body=body, refresh=True)
-    print(client.get(index=INDEX, id=key))
+    # Readers compare versions, so each tag is bumped once however many of
+    # its articles were indexed
+    try:
+        get_table(HISTORY_TABLE).update_item(
+            Key={'key': VERSIONS_KEY},
+            UpdateExpression='ADD ' + ', '.join(adds),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues={':one': 1})
+    except ClientError as e:
+        print('Could not update versions', e.response['Error']['Message'])
+
+
+def get_awsauth(region, service):
+    from requests_aws4auth import AWS4Auth
+
+    # The client outlives the role's temporary credentials in a warm
+    # container. With refreshable credentials AWS4Auth fetches the current
+    # keys for every request, so requests are never signed with expired ones
+    cred = boto3.Session().get_credentials()
+    return AWS4Auth(region=region,
+                    service=service,
+                    refreshable_credentials=cred)
+
+
+class BulkIndexer:
+    #
+    # Buffers document upserts and sends them with one _bulk request once
+    # BULK_SIZE documents are queued or BULK_INTERVAL seconds have passed.
+    # Documents are not refreshed individually; they become searchable on
+    # the index's regular refresh interval.
+    #
+
+    def __init__(self, size=BULK_SIZE, interval=BULK_INTERVAL):
+        self.size = size
+        self.interval = interval
+        self.actions = []
+        self.sources = []
+        self.failed = []
+        # Tags of the documents indexed successfully
+        self.tags = set()
+        self.last_flush = time.monotonic()
+
+    def add(self, key, doc, source=None):
+        # source identifies the event record, reported back on failure
+        self.actions.append({'update': {'_index': INDEX, '_id': key}})
+        self.actions.append({'doc': doc, 'doc_as_upsert': True})
+        self.sources.append(source)
+
+        if (len(self.actions) // 2 >= self.size or
+                time.monotonic() - self.last_flush >= self.interval):
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.actions:
+            return
+
+        actions = self.actions
+        sources = self.sources
+        self.actions = []
+        self.sources = []
+
+        try:
+            res = get_opensearch().bulk(body=actions)
+        except Exception as e:
+            print('@bulk: request failed', e)
+            self.failed.extend(sources)
+            return
+
+        print('@bulk: indexed', len(sources), 'documents in', res['took'],
+              'ms')
+
+        docs = actions[1::2]
+        for item, doc, source in zip(res['items'], docs, sources):
+            if item['update'].get('error'):
+                print('@bulk: failed', item['update'])
+                self.failed.append(source)
+            else:
+                self.tags.update(doc['doc'].get('tags', []))
 
 
 def extract_tags(data):
@@ -84,26 +247,37 @@ def extract_tags(data):
 
 
 def get_data(object_key, bucket):
-    s3client = boto3.client('s3')
-    obj = s3client.get_object(Bucket=bucket, Key=object_key)
+    obj = get_s3().get_object(Bucket=bucket, Key=object_key)
     data = obj['Body'].read().decode('utf-8')
 
     return json.loads(data)
 
 
-def insert_item(item, table):
-    db = boto3.resource('dynamodb')
-    table = db.Table(table)
+def update_metadata(key, field, value):
+    table = get_table(METADATA_TABLE)
 
-    response = table.put_item(Item=item)
+    # Sets only the new field, so the two inference results never
+    # overwrite each other; returns the merged item
+    response = table.update_item(
+        Key={'UrlHash': key},
+        UpdateExpression='SET #field = :value, #ts = :ts',
+        ConditionExpression='attribute_exists(UrlHash)',
+        ExpressionAttributeNames={
+            '#field': field,
+            '#ts': 'timestamp'
+        },
+        ExpressionAttributeValues={
+            ':value': value,
+            ':ts': datetime.datetime.now().isoformat()
+        },
+        ReturnValues='ALL_NEW')
 
-    print('@insert_item: response', response)
-    return response
+    print('@update_metadata: updated', key, field)
+    return response['Attributes']
 
 
 def get_item(key, table):
-    db = boto3.resource('dynamodb')
-    table = db.Table(table)
+    table = get_table(table)
 
     try:
         response = table.get_item(Key=key)
@@ -0,0 +1,92 @@
+import gzip
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from extract import EXTRACTORS, extract_article  # noqa: E402
+
+#
+# Per-document latency and peak memory of each HTML_PARSER extractor over
+# pages saved by the crawler, e.g. objects synced from the crawled-content
+# bucket: those are named by digest with no extension and gzipped, so every
+# file of a directory is read and gunzipped when needed. No browser or AWS
+# access is needed.
+#
+# Usage: python bench/bench_parse.py <file or directory>... [--repeat N]
+#
+
+
+def html_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                for name in sorted(names):
+                    if not name.startswith('.'):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def load(paths):
+    pages = []
+    for path in html_files(paths):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data[:2] == b'\x1f\x8b':
+            data = gzip.decompress(data)
+        pages.append(data.decode('utf-8', errors='replace'))
+    return pages
+
+
+def latency(parser, pages, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for raw in pages:
+            extract_article(raw, parser)
+        spent = time.perf_counter() - start
+        best = spent if best is None else min(best, spent)
+    return best / len(pages)
+
+
+def peak_memory(parser, pages):
+    # Largest peak over any one document, as the handler parses them one
+    # at a time. tracemalloc only sees Python allocations, so lxml's tree,
+    # which lives in libxml2, is not counted
+    peak = 0
+    for raw in pages:
+        tracemalloc.start()
+        extract_article(raw, parser)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return peak
+
+
+def main(argv):
+    repeat = 3
+    if '--repeat' in argv:
+        i = argv.index('--repeat')
+        repeat = int(argv[i + 1])
+        argv = argv[:i] + argv[i + 2:]
+
+    pages = load(argv)
+    if not pages:
+        print('Usage: python bench/bench_parse.py <file or directory>...')
+        sys.exit(1)
+
+    size = sum(len(p) for p in pages) / len(pages)
+    print(f'{len(pages)} pages, {size / 1024:.0f} KiB average, '
+          f'best of {repeat}')
+    for parser in EXTRACTORS:
+        ms = latency(parser, pages, repeat) * 1000
+        peak = peak_memory(parser, pages) / 1024
+        text = sum(len(extract_article(p, parser)[1]) for p in pages)
+        print(f'{parser:<8} {ms:8.2f} ms/doc {peak:8.0f} KiB peak '
+              f'{text / len(pages):8.0f} chars/doc')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,8 +1,8 @@
 
-pip3.9 install --target ./package bs4
+pip3.9 install --target ./package bs4 lxml
 
 cd package
 zip -r ../deployment-processor.zip .
 
 cd ../src
-zip ../deployment-processor.zip index.py
+zip ../deployment-processor.zip *.py
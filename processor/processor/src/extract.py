@@ -0,0 +1,334 @@
+import json
+import re
+
+from html.parser import HTMLParser
+
+# Elements that never hold article text
+DROP_TAGS = [
+    'script', 'style', 'noscript', 'nav', 'header', 'footer', 'aside', 'form',
+    'iframe', 'svg', 'button', 'figure'
+]
+# class/id words of navigation, banners and other page furniture, matched
+# against whole words so 'has-sidebar' matches but 'navy' or 'shared' do not
+BOILERPLATE = frozenset([
+    'nav', 'navbar', 'navigation', 'menu', 'footer', 'cookie', 'cookies',
+    'consent', 'banner', 'promo', 'share', 'sharing', 'social', 'comment',
+    'comments', 'related', 'recommend', 'recommended', 'subscribe',
+    'newsletter', 'signup', 'advert', 'advertisement', 'ad', 'ads', 'sponsor',
+    'sponsored', 'sidebar', 'breadcrumb', 'breadcrumbs', 'popup', 'modal',
+    'trending'
+])
+KEEP_TAGS = ['html', 'body', 'article', 'main']
+# Elements whose start or end closes an open <p>, whose end tag is optional
+P_CLOSERS = {
+    'address', 'article', 'aside', 'blockquote', 'body', 'details', 'div',
+    'dl', 'fieldset', 'figcaption', 'figure', 'footer', 'form', 'h1', 'h2',
+    'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'html', 'li', 'main', 'menu',
+    'nav', 'ol', 'pre', 'section', 'table', 'td', 'th', 'tr', 'ul'
+}
+# Elements whose text is never article text
+SKIP_TAGS = {'script', 'style', 'noscript', 'template'}
+
+# Paragraphs shorter than this or with more than this share of link text
+# are treated as boilerplate
+MIN_PARAGRAPH = 25
+MAX_LINK_DENSITY = 0.5
+
+ARTICLE_TYPES = {
+    'Article', 'NewsArticle', 'ReportageNewsArticle', 'AnalysisNewsArticle',
+    'BlogPosting', 'WebPage'
+}
+DATE_META = [
+    'article:published_time', 'og:published_time', 'datepublished',
+    'parsely-pub-date', 'pubdate', 'publishdate', 'date', 'dc.date',
+    'sailthru.date'
+]
+SOURCE_META = ['og:site_name', 'application-name', 'publisher']
+
+WHITESPACE = re.compile(r'\s+')
+MARKER_WORDS = re.compile(r'[\s_-]+')
+
+
+def clean(text):
+    return WHITESPACE.sub(' ', text or '').strip()
+
+
+def meta_key(attrs):
+    key = attrs.get('property') or attrs.get('name') or attrs.get('itemprop')
+    return (key or '').lower()
+
+
+def ld_objects(blob):
+    try:
+        data = json.loads(blob)
+    except ValueError:
+        return []
+
+    objs = data if isinstance(data, list) else [data]
+    out = []
+    for obj in objs:
+        if not isinstance(obj, dict):
+            continue
+        out.append(obj)
+        out.extend(o for o in obj.get('@graph', []) if isinstance(o, dict))
+    return out
+
+
+def ld_article(ld_blobs):
+    for blob in ld_blobs:
+        for obj in ld_objects(blob):
+            types = obj.get('@type', [])
+            if isinstance(types, str):
+                types = [types]
+            if ARTICLE_TYPES.intersection(types):
+                return obj
+    return {}
+
+
+def ld_name(value):
+    if isinstance(value, list):
+        value = value[0] if value else None
+    if isinstance(value, dict):
+        value = value.get('name')
+    return value if isinstance(value, str) else None
+
+
+def article_metadata(title, meta, ld_blobs, times):
+    #
+    # Title, publish date and publisher from JSON-LD first, then OpenGraph
+    # and other meta tags, then the page itself
+    #
+    article = ld_article(ld_blobs)
+
+    headline = ld_name(article.get('headline')) or meta.get('og:title')
+
+    published = ld_name(article.get('datePublished'))
+    for key in DATE_META:
+        if published:
+            break
+        published = meta.get(key)
+    if not published and times:
+        published = times[0]
+
+    source = ld_name(article.get('publisher'))
+    for key in SOURCE_META:
+        if source:
+            break
+        source = meta.get(key)
+
+    return {
+        'title': clean(headline or title) or 'None',
+        'source': clean(source) or 'unknown',
+        'published_date': clean(published) or 'unknown',
+    }
+
+
+class ParagraphParser(HTMLParser):
+    # Collects the <title>, <p> text and metadata tags in a single pass
+    # without building a tree
+
+    def __init__(self):
+        super().__init__()
+        self.title = None
+        self.in_title = False
+        self.in_ld = False
+        self.skip = 0
+        self.in_p = False
+        self.parts = []
+        self.meta = {}
+        self.ld = []
+        self.times = []
+
+    def close_p(self):
+        if self.in_p:
+            self.in_p = False
+            self.parts.append(' ')
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag in P_CLOSERS:
+            self.close_p()
+
+        if tag == 'title' and self.title is None:
+            self.in_title = True
+            self.title = ''
+        elif tag == 'p':
+            self.close_p()
+            self.in_p = True
+        elif tag == 'meta':
+            key = meta_key(attrs)
+            if key and attrs.get('content'):
+                self.meta.setdefault(key, attrs['content'])
+        elif tag == 'time' and attrs.get('datetime'):
+            self.times.append(attrs['datetime'])
+        elif tag == 'script' and attrs.get('type') == 'application/ld+json':
+            self.in_ld = True
+            self.ld.append('')
+        elif tag in SKIP_TAGS:
+            self.skip += 1
+
+    def handle_endtag(self, tag):
+        if tag in P_CLOSERS or tag == 'p':
+            self.close_p()
+
+        if tag == 'title':
+            self.in_title = False
+        elif tag == 'script' and self.in_ld:
+            self.in_ld = False
+        elif tag in SKIP_TAGS and self.skip:
+            self.skip -= 1
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title += data
+        elif self.in_ld:
+            self.ld[-1] += data
+        elif self.in_p and not self.skip:
+            self.parts.append(data)
+
+
+def extract_stream(raw_content):
+    parser = ParagraphParser()
+    parser.feed(raw_content)
+    parser.close()
+
+    metadata = article_metadata(parser.title, parser.meta, parser.ld,
+                                parser.times)
+    return metadata, ''.join(parser.parts)
+
+
+def paragraph_stats(p):
+    text = clean(p.text_content())
+    if not text:
+        return text, 1.0
+    link_len = sum(len(clean(a.text_content())) for a in p.iter('a'))
+    return text, link_len / len(text)
+
+
+def block_scores(doc):
+    #
+    # Scores every block by the amount of non-link paragraph text it holds
+    # (half of it also counts for the grandparent)
+    #
+    scores = {}
+    for p in doc.iter('p'):
+        text, density = paragraph_stats(p)
+        if len(text) < MIN_PARAGRAPH or density > MAX_LINK_DENSITY:
+            continue
+
+        score = len(text) * (1 - density)
+        parent = p.getparent()
+        if parent is None:
+            continue
+        scores[parent] = scores.get(parent, 0) + score
+        grandparent = parent.getparent()
+        if grandparent is not None:
+            scores[grandparent] = scores.get(grandparent, 0) + score / 2
+    return scores
+
+
+def main_paragraphs(doc):
+    # Paragraphs of the best scoring block
+    scores = block_scores(doc)
+    if not scores:
+        return [clean(p.text_content()) for p in doc.iter('p')]
+
+    top = max(scores, key=scores.get)
+    paragraphs = []
+    for p in top.iter('p'):
+        text, density = paragraph_stats(p)
+        if len(text) >= MIN_PARAGRAPH and density <= MAX_LINK_DENSITY:
+            paragraphs.append(text)
+    return paragraphs
+
+
+def is_boilerplate(el):
+    marker = f'{el.get("class", "")} {el.get("id", "")}'.lower()
+    return not BOILERPLATE.isdisjoint(MARKER_WORDS.split(marker))
+
+
+def extract_lxml(raw_content):
+    import lxml.html
+
+    try:
+        doc = lxml.html.fromstring(raw_content)
+    except ValueError:
+        # str input with an XML encoding declaration
+        doc = lxml.html.fromstring(raw_content.encode('utf-8'))
+
+    title = doc.findtext('.//title')
+    meta = {}
+    for m in doc.iter('meta'):
+        key = meta_key(m.attrib)
+        if key and m.get('content'):
+            meta.setdefault(key, m.get('content'))
+    ld = [
+        s.text_content()
+        for s in doc.xpath('//script[@type="application/ld+json"]')
+    ]
+    times = [t.get('datetime') for t in doc.iter('time') if t.get('datetime')]
+    metadata = article_metadata(title, meta, ld, times)
+
+    if doc.find('head') is not None:
+        doc.find('head').drop_tree()
+    everything = [clean(p.text_content()) for p in doc.iter('p')]
+
+    # Strip page furniture before scoring the remaining blocks, except
+    # whatever holds the best block of the untouched page, so a furniture
+    # class on a page wrapper cannot take the article with it
+    scores = block_scores(doc)
+    keep = set()
+    if scores:
+        top = max(scores, key=scores.get)
+        keep.add(top)
+        keep.update(top.iterancestors())
+
+    for el in doc.xpath('|'.join(f'//{t}' for t in DROP_TAGS)):
+        if el not in keep:
+            el.drop_tree()
+    for el in list(doc.iter()):
+        if (not isinstance(el.tag, str) or el.tag in KEEP_TAGS
+                or el in keep or el.getparent() is None):
+            continue
+        if is_boilerplate(el):
+            el.drop_tree()
+
+    text = ' '.join(main_paragraphs(doc)).strip()
+    return metadata, text or ' '.join(everything)
+
+
+def extract_bs4(raw_content):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(raw_content, 'html.parser')
+
+    title = soup.find('title')
+    meta = {}
+    for m in soup.find_all('meta'):
+        key = meta_key(m.attrs)
+        if key and m.get('content'):
+            meta.setdefault(key, m.get('content'))
+    ld = [
+        s.get_text()
+        for s in soup.find_all('script', type='application/ld+json')
+    ]
+    times = [t['datetime'] for t in soup.find_all('time', datetime=True)]
+    metadata = article_metadata(title and title.string, meta, ld, times)
+
+    text = ' '.join(para.get_text() for para in soup.find_all('p'))
+    return metadata, text
+
+
+#
+# 'lxml' keeps only the main article text; 'stream' and 'bs4' return every
+# paragraph of the page but read the same metadata
+#
+EXTRACTORS = {
+    'lxml': extract_lxml,
+    'stream': extract_stream,
+    'bs4': extract_bs4,
+}
+
+
+def extract_article(raw_content, parser='lxml'):
+    return EXTRACTORS[parser](raw_content)
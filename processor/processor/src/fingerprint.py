@@ -0,0 +1,61 @@
+import hashlib
+import re
+
+#
+# Content fingerprints for spotting articles that were already sent for
+# inference: an exact hash of the normalized text, and a 64-bit SimHash
+# over word shingles for near-duplicates such as the same wire story
+# republished with a different header or footer.
+#
+
+SIMHASH_BITS = 64
+SHINGLE_SIZE = 3
+# Two texts are near-duplicates when their SimHashes differ in at most
+# MAX_DISTANCE bits. With BANDS > MAX_DISTANCE such hashes always share at
+# least one band exactly, so candidates can be found by band lookups.
+MAX_DISTANCE = 3
+BANDS = 4
+BAND_BITS = SIMHASH_BITS // BANDS
+# Shorter texts (teasers, paywall stubs, pages the extractor mostly
+# missed) look alike across unrelated articles and are not fingerprinted
+MIN_WORDS = 50
+
+WORD = re.compile(r'\w+')
+
+
+def words(text):
+    return WORD.findall(text.lower())
+
+
+def exact_hash(text):
+    return hashlib.sha1(' '.join(words(text)).encode('utf-8')).hexdigest()
+
+
+def simhash(text):
+    tokens = words(text)
+    if len(tokens) >= SHINGLE_SIZE:
+        shingles = set(' '.join(tokens[i:i + SHINGLE_SIZE])
+                       for i in range(len(tokens) - SHINGLE_SIZE + 1))
+    else:
+        shingles = set(tokens)
+
+    weights = [0] * SIMHASH_BITS
+    for s in shingles:
+        h = int.from_bytes(hashlib.md5(s.encode('utf-8')).digest()[:8], 'big')
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if h >> bit & 1 else -1
+
+    value = 0
+    for bit in range(SIMHASH_BITS):
+        if weights[bit] > 0:
+            value |= 1 << bit
+    return value
+
+
+def bands(value):
+    mask = (1 << BAND_BITS) - 1
+    return [(value >> (i * BAND_BITS)) & mask for i in range(BANDS)]
+
+
+def distance(a, b):
+    return bin(a ^ b).count('1')
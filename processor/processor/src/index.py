@@ -1,11 +1,22 @@
+import gzip
+import hashlib
 import json
 import os
 import re
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 
 import boto3
 
-from bs4 import BeautifulSoup
-# from keybert import KeyBERT
+from botocore.exceptions import ClientError
+
+from extract import extract_article
+from fingerprint import (MAX_DISTANCE, MIN_WORDS, bands, distance,
+                         exact_hash, simhash, words)
+from keywords import DocumentFrequency, extract_keywords
 
 REGION = os.environ['REGION']
 INF_METADATA_TABLE = os.environ['INF_METADATA_TABLE']
@@ -13,33 +24,128 @@ METADATA_TABLE = os.environ['METADATA_TABLE']
 PAYLOAD_BUCKET = os.environ['PAYLOAD_BUCKET']
 CLASSIFICATION_ENDPOINT = os.environ['CLASSIFICATION_ENDPOINT']
 SUMMARY_ENDPOINT = os.environ['SUMMARY_ENDPOINT']
+# Content fingerprints used to skip inference of duplicate articles;
+# deduplication is off when unset
+FINGERPRINT_TABLE = os.environ.get('FINGERPRINT_TABLE')
 
+# HTML parser used by parse_data: 'lxml' (main article text only),
+# 'stream' (stdlib, no dependencies) or 'bs4' (BeautifulSoup html.parser,
+# the slowest)
+HTML_PARSER = os.environ.get('HTML_PARSER', 'lxml')
+
+# Document frequencies used to rank keywords, shared by all containers
+# and stored in the payload bucket
+KEYWORD_DF_KEY = os.environ.get('KEYWORD_DF_KEY',
+                                'keywords/document-frequency.json.gz')
+# Counts of a container are merged into the stored table once it has seen
+# this many documents or this many seconds have passed since its last save.
+# Counts of a container shut down in between are lost, which only leaves
+# the frequencies slightly stale.
+KEYWORD_DF_FLUSH_DOCS = int(os.environ.get('KEYWORD_DF_FLUSH_DOCS', '500'))
+KEYWORD_DF_FLUSH_INTERVAL = float(
+    os.environ.get('KEYWORD_DF_FLUSH_INTERVAL', '300'))
+
+# Records of a batch fetched, parsed and submitted concurrently
+WORKERS = int(os.environ.get('PROCESSOR_WORKERS', '8'))
+# Articles packed into one payload per inference endpoint
+INFERENCE_BATCH_SIZE = int(os.environ.get('INFERENCE_BATCH_SIZE', '8'))
+
+
+# Created on first use and reused by warm invocations of the container.
+# Records are handled on several threads, and creating boto3 clients
+# concurrently from the default session is not thread-safe
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(name):
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = boto3.client(name)
+        return _clients[name]
+
+
+def get_dynamodb():
+    with _clients_lock:
+        if 'dynamodb' not in _clients:
+            _clients['dynamodb'] = boto3.resource('dynamodb')
+        return _clients['dynamodb']
 
-def lambda_handler(event, context):
-    print("Received event: " + json.dumps(event))
 
-    metadata, content = get_page_content(event)
+def get_table(name):
+    return get_dynamodb().Table(name)
 
-    keywords = get_keywords(content)
-    metadata['keywords'] = keywords
-    print(metadata)
 
-    insert_item(metadata, METADATA_TABLE)
-    put_payload(metadata['UrlHash'], PAYLOAD_BUCKET, content[:2200])
+# Loaded once per container and merged back into the stored table every
+# KEYWORD_DF_FLUSH_DOCS documents or KEYWORD_DF_FLUSH_INTERVAL seconds
+_frequency = None
+_frequency_saved = 0
+_frequency_lock = threading.Lock()
 
-    # async inference endpoint
-    out_c = run_inference(content, metadata['UrlHash'], PAYLOAD_BUCKET,
-                          CLASSIFICATION_ENDPOINT)
-    out_s = run_inference(content, metadata['UrlHash'], PAYLOAD_BUCKET,
-                          SUMMARY_ENDPOINT)
 
-    inf_metadata = {'UrlHash': metadata['UrlHash']}
+def lambda_handler(event, context):
+    print("Received event: " + json.dumps(event))
+
+    records = list(s3_records(event))
+    failures = set()
 
-    inf_metadata['OutputLocation'] = out_c
-    insert_item(inf_metadata, INF_METADATA_TABLE)
+    # Fetching and parsing is mostly S3 latency; overlap it across records
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        pages = list(executor.map(load_page, records))
 
-    inf_metadata['OutputLocation'] = out_s
-    insert_item(inf_metadata, INF_METADATA_TABLE)
+    articles = []
+    for (message_id, _), page in zip(records, pages):
+        if page is None:
+            failures.add(message_id)
+            continue
+
+        metadata, content = page
+        print(metadata)
+        articles.append((message_id, metadata, content))
+
+    # Reuse summary and tags of articles with the same or nearly the same
+    # text; must run before the metadata of re-crawled articles is replaced
+    fingerprints = {
+        metadata['UrlHash']: content_fingerprint(content)
+        for _, metadata, content in articles
+    }
+    reused = reuse_inference(articles, fingerprints)
+
+    write_items([metadata for _, metadata, _ in articles], METADATA_TABLE)
+
+    pending = [a for a in articles if a[1]['UrlHash'] not in reused]
+    batches = [
+        pending[i:i + INFERENCE_BATCH_SIZE]
+        for i in range(0, len(pending), INFERENCE_BATCH_SIZE)
+    ]
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        results = list(executor.map(submit_inference, batches))
+
+    inf_items = []
+    submitted = []
+    for batch, items in zip(batches, results):
+        if items is None:
+            failures.update(message_id for message_id, _, _ in batch)
+        else:
+            inf_items.extend(items)
+            submitted.extend(metadata['UrlHash'] for _, metadata, _ in batch)
+
+    write_items(inf_items, INF_METADATA_TABLE)
+    register_fingerprints(submitted, fingerprints)
+    save_frequency()
+
+    print('Processed', len(articles), 'of', len(records), 'records')
+
+    # Only SQS can retry individual records of a batch; a plain S3
+    # notification is retried as a whole by failing the invocation
+    if None in failures:
+        raise RuntimeError(f'{len(failures)} records failed')
+    if failures:
+        return {
+            'batchItemFailures': [{
+                'itemIdentifier': m
+            } for m in sorted(failures)]
+        }
 
     return {
         'statusCode': 200,
@@ -47,8 +153,178 @@ def lambda_handler(event, context):
     }
 
 
-def run_inference(text, key, bucket, endpoint_name):
-    smr_client = boto3.client('sagemaker-runtime')
+def s3_records(event):
+    # Yields (sqs message id, s3 record) for plain S3 notifications and for
+    # S3 notifications delivered through an SQS batch
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            body = json.loads(record['body'])
+            for r in body.get('Records', []):
+                yield record['messageId'], r
+        elif 's3' in record:
+            yield None, record
+
+
+def load_page(record):
+    (_, s3_record) = record
+    try:
+        return get_page_content(s3_record)
+    except Exception as e:
+        print('Could not process', s3_record['s3']['object']['key'], e)
+        return None
+
+
+def submit_inference(batch):
+    #
+    # One payload and one async invocation per endpoint for the whole
+    # batch. The inference metadata lists the UrlHash of every input in
+    # order, so the indexer can fan the outputs back out per article.
+    #
+    keys = [metadata['UrlHash'] for _, metadata, _ in batch]
+    payload_key = 'batch-' + hashlib.md5(''.join(keys).encode()).hexdigest()
+    try:
+        put_payload(payload_key, PAYLOAD_BUCKET,
+                    [content[:2200] for _, _, content in batch])
+
+        # async inference endpoint
+        out_c = run_inference(payload_key, PAYLOAD_BUCKET,
+                              CLASSIFICATION_ENDPOINT)
+        out_s = run_inference(payload_key, PAYLOAD_BUCKET, SUMMARY_ENDPOINT)
+    except Exception as e:
+        print('Could not run inference for', keys, e)
+        return None
+
+    return [
+        {
+            'UrlHash': keys[0],
+            'UrlHashes': keys,
+            'OutputLocation': out_c
+        },
+        {
+            'UrlHash': keys[0],
+            'UrlHashes': keys,
+            'OutputLocation': out_s
+        },
+    ]
+
+
+def content_fingerprint(content):
+    # None for articles that are neither looked up nor registered
+    if not FINGERPRINT_TABLE or len(words(content)) < MIN_WORDS:
+        return None
+    return exact_hash(content), simhash(content)
+
+
+def reuse_inference(articles, fingerprints):
+    if not FINGERPRINT_TABLE or not articles:
+        return set()
+
+    # One batched read for the exact and band items of every article
+    keys = set()
+    for fingerprint in fingerprints.values():
+        if fingerprint is None:
+            continue
+        (exact, sim) = fingerprint
+        keys.add('x#' + exact)
+        keys.update(band_key(i, b) for i, b in enumerate(bands(sim)))
+    items = batch_get(FINGERPRINT_TABLE, [{'fp': k} for k in keys])
+    items = {item['fp']: item for item in items}
+
+    sources = {}
+    stats = {'exact': 0, 'near': 0, 'miss': 0}
+    for _, metadata, _ in articles:
+        key = metadata['UrlHash']
+        if fingerprints[key] is None:
+            continue
+        (exact, sim) = fingerprints[key]
+
+        if 'x#' + exact in items:
+            sources[key] = (items['x#' + exact]['UrlHash'], 'exact')
+            continue
+
+        for i, b in enumerate(bands(sim)):
+            item = items.get(band_key(i, b), {})
+            near = [
+                m.split(':', 1)[1] for m in item.get('members', [])
+                if distance(int(m.split(':', 1)[0], 16), sim) <= MAX_DISTANCE
+            ]
+            if near:
+                sources[key] = (near[0], 'near')
+                break
+
+    # Only sources whose inference has completed can be reused
+    source_keys = set(source for source, _ in sources.values())
+    found = batch_get(METADATA_TABLE, [{'UrlHash': k} for k in source_keys])
+    done = {
+        item['UrlHash']: item
+        for item in found
+        if 'tags' in item and 'summary' in item
+    }
+
+    reused = set()
+    for _, metadata, _ in articles:
+        key = metadata['UrlHash']
+        (source, kind) = sources.get(key, (None, 'miss'))
+        if source not in done:
+            stats['miss'] += 1
+            continue
+
+        stats[kind] += 1
+        metadata['tags'] = done[source]['tags']
+        metadata['summary'] = done[source]['summary']
+        if source != key:
+            # Syndicated copy; the original stays the indexed article
+            metadata['duplicate_of'] = source
+        reused.add(key)
+
+    total = len(articles)
+    print(f'@reuse_inference: exact={stats["exact"]} near={stats["near"]} '
+          f'miss={stats["miss"]} '
+          f'hit_rate={(total - stats["miss"]) / total:.0%}')
+    return reused
+
+
+def register_fingerprints(keys, fingerprints):
+    keys = [k for k in keys if fingerprints[k] is not None]
+    if not FINGERPRINT_TABLE or not keys:
+        return
+
+    table = get_table(FINGERPRINT_TABLE)
+    with table.batch_writer() as batch:
+        for key in keys:
+            (exact, _) = fingerprints[key]
+            batch.put_item(Item={'fp': 'x#' + exact, 'UrlHash': key})
+
+    for key in keys:
+        (_, sim) = fingerprints[key]
+        member = f'{sim:016x}:{key}'
+        for i, b in enumerate(bands(sim)):
+            table.update_item(Key={'fp': band_key(i, b)},
+                              UpdateExpression='ADD members :m',
+                              ExpressionAttributeValues={':m': {member}})
+
+
+def band_key(i, value):
+    return f'b{i}#{value:04x}'
+
+
+def batch_get(table_name, keys):
+    items = []
+    db = get_dynamodb()
+
+    # BatchGetItem takes at most 100 keys per request
+    for i in range(0, len(keys), 100):
+        request = {table_name: {'Keys': keys[i:i + 100]}}
+        while request:
+            response = db.batch_get_item(RequestItems=request)
+            items.extend(response['Responses'].get(table_name, []))
+            request = response.get('UnprocessedKeys')
+
+    return items
+
+
+def run_inference(key, bucket, endpoint_name):
+    smr_client = get_client('sagemaker-runtime')
 
     response = smr_client.invoke_endpoint_async(EndpointName=endpoint_name,
                                                 InputLocation='s3://' + bucket +
@@ -64,16 +340,14 @@ def run_inference(text, key, bucket, endpoint_name):
 def put_payload(key, bucket, data):
     body = json.dumps({'inputs': data})
 
-    s3client = boto3.client('s3')
-    response = s3client.put_object(Body=body, Bucket=bucket, Key=key)
+    response = get_client('s3').put_object(Body=body, Bucket=bucket, Key=key)
 
     print(response)
     return response
 
 
 def insert_item(item, table):
-    db = boto3.resource('dynamodb')
-    table = db.Table(table)
+    table = get_table(table)
 
     response = table.put_item(Item=item)
 
@@ -81,74 +355,108 @@ def insert_item(item, table):
     return response
 
 
+def write_items(items, table):
+    if not items:
+        return
+
+    table = get_table(table)
+
+    # batch_writer groups puts into BatchWriteItem calls of up to 25 items
+    # and resends unprocessed ones
+    with table.batch_writer() as batch:
+        for item in items:
+            batch.put_item(Item=item)
+
+    print('@write_items: wrote', len(items), 'items')
+
+
 def get_keywords(text):
-    # kw_model = KeyBERT('./keybert')
-    # keywords = kw_model.extract_keywords(text,
-    #                                      stop_words='english',
-    #                                      keyphrase_ngram_range=(1, 2),
-    #                                      use_maxsum=True,
-    #                                      use_mmr=True,
-    #                                      diversity=0.7,
-    #                                      nr_candidates=20,
-    #                                      top_n=10)
-
-    # kws = []
-    # for k in keywords:
-    #     kws.append(k[0])
-    # return kws
-    return ['kw1', 'kw2']
-
-
-def get_page_content(event):
-    key, url, raw_content = get_data(event)
+    global _frequency, _frequency_saved
+
+    with _frequency_lock:
+        if _frequency is None:
+            _frequency = DocumentFrequency(load_frequency())
+            _frequency_saved = time.time()
+        return extract_keywords(text, _frequency)
+
+
+def load_frequency():
+    try:
+        obj = get_client('s3').get_object(Bucket=PAYLOAD_BUCKET,
+                                          Key=KEYWORD_DF_KEY)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        return None
+
+    return json.loads(gzip.decompress(obj['Body'].read()))
+
+
+def save_frequency():
+    global _frequency_saved
+
+    with _frequency_lock:
+        if _frequency is None or not _frequency.pending_docs:
+            return
+        if (_frequency.pending_docs < KEYWORD_DF_FLUSH_DOCS and
+                time.time() - _frequency_saved < KEYWORD_DF_FLUSH_INTERVAL):
+            return
+
+        # Counts from other containers since the table was loaded are kept;
+        # a concurrent save in between can still drop one of the two
+        # updates, which only makes the frequencies slightly stale
+        try:
+            data = _frequency.merge(load_frequency())
+            get_client('s3').put_object(
+                Body=gzip.compress(json.dumps(data).encode('utf-8')),
+                Bucket=PAYLOAD_BUCKET,
+                Key=KEYWORD_DF_KEY)
+        except Exception as e:
+            print('Could not save keyword frequencies', e)
+            return
+        _frequency.saved(data)
+        _frequency_saved = time.time()
+
+    print('@save_frequency:', data['docs'], 'documents,', len(data['df']),
+          'terms')
+
+
+def get_page_content(record):
+    key, url, raw_content = get_data(record)
 
     metadata, content = parse_data(raw_content)
     metadata['url'] = url
     metadata['UrlHash'] = key
 
+    if metadata['source'] == 'unknown':
+        metadata['source'] = urlparse(url).netloc
+
     return metadata, content
 
 
-def get_data(event):
-    object_key = event['Records'][0]['s3']['object']['key']
-    bucket = event['Records'][0]['s3']['bucket']['name']
+def get_data(record):
+    object_key = record['s3']['object']['key']
+    bucket = record['s3']['bucket']['name']
 
-    s3client = boto3.client('s3')
-    obj = s3client.get_object(Bucket=bucket, Key=object_key)
+    obj = get_client('s3').get_object(Bucket=bucket, Key=object_key)
     url = obj['ResponseMetadata']['HTTPHeaders']['x-amz-meta-url']
-    data = obj['Body'].read().decode('utf-8')
+    data = obj['Body'].read()
 
-    return object_key, url, data
+    # The crawler uploads pages gzip-compressed
+    if obj.get('ContentEncoding') == 'gzip':
+        data = gzip.decompress(data)
+    data = data.decode('utf-8')
 
+    return object_key, url, data
 
-def parse_data(raw_content):
-    # TODO:
-    #       Do HTML parsing to retrieve required data
 
-    soup = BeautifulSoup(raw_content, 'html.parser')
-    title = str(soup.find('title').string)
-    text = ''
+def parse_data(raw_content, parser=HTML_PARSER):
+    metadata, text = extract_article(raw_content, parser)
 
-    # getting all the paragraphs
-    for para in soup.find_all('p'):
-        text += str(para.get_text())
+    # Phrases are split at punctuation, so keywords come from the text
+    # before it is stripped
+    metadata['keywords'] = get_keywords(text)
 
     text = re.sub(r'[^\w\s]', '', text)
 
-    source = 'unknown'
-    pdate = 'Mon 28 Nov 2022 11.00 EST'
-
-    # content = json.loads(raw_content)
-
-    # title = content['title']
-    # source = content['source']
-    # pdate = content['date']
-    # text = content['text']
-
-    metadata = {
-        'title': title,
-        'source': source,
-        'published_date': pdate,
-    }
-
     return metadata, text
@@ -0,0 +1,140 @@
+import math
+import re
+
+from collections import Counter
+
+#
+# Keyword extraction without a model. Candidate phrases are the runs of
+# words between stop words and punctuation (as in RAKE), cut into n-grams
+# of up to MAX_NGRAM words and ranked by TF-IDF, with document
+# frequencies accumulated over every article processed so far.
+#
+
+MAX_NGRAM = 2
+TOP_N = 10
+MIN_WORD_LENGTH = 3
+# Only the most frequent phrases are kept beyond this many, which bounds
+# the size of the persisted table
+MAX_TERMS = 100000
+
+TOKEN = re.compile(r"\w+(?:['’-]\w+)*|[^\w\s]")
+
+STOP_WORDS = frozenset('''
+a about above according across after afterwards again against ago all
+almost alone along already also although always am among amongst an and
+another any anyone anything anyway anywhere are around as at back be
+became because become becomes been before behind being below beside
+besides between beyond both but by can cannot could did do does doing
+done down during each either else elsewhere enough etc even ever every
+everyone everything except few first for former formerly from further
+get gets got had has have having he her here hers herself him himself
+his how however i if in including into is it its itself just last least
+less like made make many may me meanwhile might mine more moreover most
+mostly much must my myself near nearly neither never nevertheless new
+next no nobody none nor not nothing now of off often on once one only
+onto or other others otherwise our ours ourselves out over own per
+perhaps please put rather really said same say says see seem seemed
+seems several she should since so some someone something sometimes
+still such than that the their theirs them themselves then there
+thereby therefore these they this those though through throughout thus
+to together too toward towards under until up upon us very via was we
+well were what whatever when whenever where whereas whether which while
+who whoever whole whom whose why will with within without would yet you
+your yours yourself yourselves
+monday tuesday wednesday thursday friday saturday sunday today
+yesterday tomorrow week year years time times people told
+'''.split())
+
+
+class DocumentFrequency:
+    def __init__(self, data=None):
+        data = data or {}
+        self.docs = data.get('docs', 0)
+        self.df = Counter(data.get('df', {}))
+
+        # Counts added since the table was loaded; other containers update
+        # the stored table concurrently, so only these are merged into it
+        self.pending_docs = 0
+        self.pending = Counter()
+
+    def add(self, terms):
+        terms = set(terms)
+        self.docs += 1
+        self.df.update(terms)
+        self.pending_docs += 1
+        self.pending.update(terms)
+
+    def idf(self, term):
+        return math.log((1 + self.docs) / (1 + self.df[term])) + 1
+
+    # Stored table with the counts added here on top
+    def merge(self, data):
+        merged = DocumentFrequency(data)
+        merged.docs += self.pending_docs
+        merged.df.update(self.pending)
+
+        df = dict(merged.df.most_common(MAX_TERMS))
+
+        return {'docs': merged.docs, 'df': df}
+
+    def saved(self, data):
+        self.docs = data['docs']
+        self.df = Counter(data['df'])
+        self.pending_docs = 0
+        self.pending = Counter()
+
+
+def is_word(token):
+    return (len(token) >= MIN_WORD_LENGTH and token[0].isalpha()
+            and token not in STOP_WORDS)
+
+
+def ngrams(run):
+    for n in range(1, MAX_NGRAM + 1):
+        for i in range(len(run) - n + 1):
+            yield ' '.join(run[i:i + n])
+
+
+def candidates(text):
+    phrases = []
+    run = []
+    for token in TOKEN.findall(text.lower()):
+        if token.endswith("'s") or token.endswith("’s"):
+            token = token[:-2]
+
+        if is_word(token):
+            run.append(token)
+        else:
+            phrases.extend(ngrams(run))
+            run = []
+    phrases.extend(ngrams(run))
+
+    return phrases
+
+
+def extract_keywords(text, frequency, top_n=TOP_N):
+    tf = Counter(candidates(text))
+    frequency.add(tf)
+
+    # Longer phrases are favoured over the single words they contain, as
+    # RAKE does by summing word scores
+    scores = {
+        term: count * frequency.idf(term) * math.sqrt(term.count(' ') + 1)
+        for term, count in tf.items()
+    }
+
+    # Skip phrases that only repeat words of a better ranked phrase, so
+    # 'prime minister' does not also bring in 'minister'
+    keywords = []
+    chosen = []
+    for term in sorted(scores, key=lambda t: (-scores[t], t)):
+        words = set(term.split())
+        if any(words <= c or c <= words for c in chosen):
+            continue
+
+        keywords.append(term)
+        chosen.append(words)
+        if len(keywords) == top_n:
+            break
+
+    return keywords